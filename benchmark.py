@@ -0,0 +1,442 @@
+"""Offline throughput benchmark: python -m benchmark --dialogs 20 --pairs 50 --latency-ms 80 --flood-every 200
+
+Caption parsing alone: python -m benchmark --captions 200000"""
+import argparse
+import asyncio
+import datetime
+import json
+import os
+import random
+import re
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+
+from telethon import errors
+from telethon.tl import types
+from telethon.tl.types import InputMessagesFilterDocument, InputMessagesFilterPhotos, InputPeerChannel
+
+from caption_parser import CaptionParser
+from photo_sizes import INLINE_SIZES, photo_size_bytes
+from scraper_engine import ScraperEngine
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+# Search term every generated image caption contains
+BENCHMARK_QUERY = "bench"
+
+# Telethon returns history in pages of this many messages, one request each
+FAKE_PAGE_SIZE = 100
+
+
+class FakeFile:
+    """The message.file fields the engine reads"""
+    def __init__(self, name, ext, size):
+        self.name = name
+        self.ext = ext
+        self.size = size
+
+
+class FakeMedia:
+    """Stand-in for a Photo or Document"""
+    def __init__(self, id, size, sizes=()):
+        self.id = id
+        self.access_hash = id * 7
+        self.size = size
+        # The PhotoSizes of a photo; documents have none
+        self.sizes = list(sizes)
+
+
+def fake_photo_sizes(size):
+    """Return the sizes Telegram keeps of a photo whose largest version has size bytes"""
+    sizes = [types.PhotoStrippedSize(type="i", bytes=bytes(40))]
+    for size_type, pixels in (("s", 90), ("m", 320), ("x", 800)):
+        # Bytes grow with the area of the picture
+        sizes.append(types.PhotoSize(type=size_type, w=pixels, h=pixels, size=max(1, size * pixels ** 2 // 1280 ** 2)))
+    sizes.append(types.PhotoSizeProgressive(type="y", w=1280, h=1280, sizes=[size // 8, size // 2, size]))
+    return sizes
+
+
+class FakeMessage:
+    """A generated photo or archive message"""
+    def __init__(self, id, chat_id, text, photo=None, document=None, file=None):
+        self.id = id
+        self.chat_id = chat_id
+        self.text = text
+        self.date = datetime.datetime.fromtimestamp(1700000000 + id, datetime.timezone.utc)
+        self.photo = photo
+        self.document = document
+        self.media = photo or document
+        self.file = file
+
+
+class FakeDialog:
+    """A generated channel with its messages, newest first"""
+    def __init__(self, id, name, messages):
+        self.id = id
+        self.name = name
+        self.entity = InputPeerChannel(channel_id=id, access_hash=id * 31)
+        self.is_user = False
+        self.is_group = False
+        self.date = datetime.datetime.now(datetime.timezone.utc)
+        self.messages = sorted(messages, key=lambda message: -message.id)
+
+
+def build_dialogs(dialog_count, pairs_per_dialog, image_size, archive_size):
+    """Generate dialogs that each hold pairs of a captioned photo and its archive"""
+    dialogs = []
+    for d in range(dialog_count):
+        dialog_id = 1000 + d
+        messages = []
+        for p in range(pairs_per_dialog):
+            code = f"B{d:03d}P{p:04d}"
+            image_id = (d * pairs_per_dialog + p) * 2 + 1
+            messages.append(FakeMessage(
+                image_id, dialog_id, f"{code} Benchmark item {d} {p} {BENCHMARK_QUERY} #sample",
+                photo=FakeMedia(image_id, image_size, fake_photo_sizes(image_size)),
+                file=FakeFile(None, ".jpg", image_size)
+            ))
+            messages.append(FakeMessage(
+                image_id + 1, dialog_id, f"{code} archive",
+                document=FakeMedia(image_id + 1, archive_size),
+                file=FakeFile(f"{code}.zip", ".zip", archive_size)
+            ))
+        dialogs.append(FakeDialog(dialog_id, f"Bench {d}", messages))
+    return dialogs
+
+
+class FakeRequest:
+    """Stand-in for a TL request; QUALNAME is what the metrics name requests by"""
+    def __init__(self, qualname, size=0):
+        self.QUALNAME = qualname
+        self.size = size
+
+
+class FakeTelegramClient:
+    """In-process TelegramClient stand-in with simulated latency, bandwidth and FloodWaits"""
+    def __init__(self, dialogs, latency=0.05, bandwidth=0, flood_every=0, flood_seconds=1):
+        self.dialogs = {dialog.id: dialog for dialog in dialogs}
+        self.latency = latency
+        # Bytes per second of a single request stream; 0 means unlimited
+        self.bandwidth = bandwidth
+        self.flood_every = flood_every
+        self.flood_seconds = flood_seconds
+        self.connected = False
+
+        self.rpc_counts = {}
+        self.flood_waits = 0
+        self.bytes_served = 0
+        self.payload = bytes(512 * 1024)
+
+    async def _request(self, method, size=0):
+        await self._call(None, FakeRequest(method, size))
+
+    async def _call(self, sender, request):
+        # Named like TelegramClient._call, so metrics instrumentation sees every simulated request
+        method = request.QUALNAME
+        size = request.size
+        # Every simulated request counts, including those answered with a FloodWait
+        self.rpc_counts[method] = self.rpc_counts.get(method, 0) + 1
+        if self.flood_every and sum(self.rpc_counts.values()) % self.flood_every == 0:
+            self.flood_waits += 1
+            raise errors.FloodWaitError(request=None, capture=self.flood_seconds)
+
+        delay = self.latency + (size / self.bandwidth if self.bandwidth else 0)
+        await asyncio.sleep(delay)
+        self.bytes_served += size
+
+    def _dialog_for(self, entity):
+        if isinstance(entity, InputPeerChannel):
+            return self.dialogs[entity.channel_id]
+        return self.dialogs[entity]
+
+    def is_connected(self):
+        return self.connected
+
+    async def connect(self):
+        self.connected = True
+
+    async def disconnect(self):
+        self.connected = False
+
+    async def is_user_authorized(self):
+        return True
+
+    async def iter_dialogs(self, **kwargs):
+        await self._request("messages.GetDialogs")
+        for index, dialog in enumerate(self.dialogs.values(), 1):
+            yield dialog
+            if index % FAKE_PAGE_SIZE == 0:
+                await self._request("messages.GetDialogs")
+
+    async def iter_messages(self, entity, search=None, filter=None, min_id=0, offset_id=0, **kwargs):
+        method = "messages.Search" if search or filter else "messages.GetHistory"
+        await self._request(method)
+        count = 0
+        for message in self._dialog_for(entity).messages:
+            if offset_id and message.id >= offset_id:
+                continue
+            if message.id <= min_id:
+                break
+            if search and search not in (message.text or ""):
+                continue
+            if filter is InputMessagesFilterDocument and message.document is None:
+                continue
+            if filter is InputMessagesFilterPhotos and message.photo is None:
+                continue
+            yield message
+            count += 1
+            if count % FAKE_PAGE_SIZE == 0:
+                await self._request(method)
+
+    async def get_messages(self, entity, ids=None):
+        await self._request("channels.GetMessages")
+        by_id = {message.id: message for message in self._dialog_for(entity).messages}
+        # Like Telethon: a list of ids gives a list with None for missing messages
+        if isinstance(ids, list):
+            return [by_id.get(message_id) for message_id in ids]
+        return by_id.get(ids)
+
+    async def download_media(self, media, file=None, progress_callback=None, thumb=None, **kwargs):
+        photo_size = next((size for size in media.sizes if size.type == thumb), None) if thumb else None
+        size = photo_size_bytes(photo_size) if photo_size is not None else media.size
+        # Like Telethon, inline sizes are written without a request
+        if not isinstance(photo_size, INLINE_SIZES):
+            await self._request("upload.GetFile", size)
+        with open(file, 'wb') as f:
+            # A distinct header per media keeps the content-hash dedup from linking generated files
+            f.write(media.id.to_bytes(8, "big"))
+            f.write(bytes(max(0, size - 8)))
+        if progress_callback:
+            progress_callback(size, size)
+        return file
+
+    async def iter_download(self, media, offset=0, limit=None, request_size=512 * 1024, file_size=None, **kwargs):
+        file_size = file_size or media.size
+        position = offset
+        sent = 0
+        view = memoryview(self.payload)
+        while position < file_size and (limit is None or sent < limit):
+            length = min(request_size, file_size - position)
+            await self._request("upload.GetFile", length)
+            if position == 0:
+                yield media.id.to_bytes(8, "big") + bytes(view[8:length])
+            else:
+                yield view[:length]
+            position += length
+            sent += 1
+
+
+def peak_memory_bytes():
+    """Return the peak resident set size of this process, or None where it is unknown"""
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+def directory_bytes(path):
+    return sum(entry.stat().st_size for entry in os.scandir(path) if entry.is_file())
+
+
+async def run_benchmark(options, engine_overrides=None, log_callback=None):
+    """Run one full search and download job against the fake client and return its measurements"""
+    dialogs = build_dialogs(options.dialogs, options.pairs, options.image_kb * 1024, int(options.archive_mb * 1024 * 1024))
+    client = FakeTelegramClient(
+        dialogs,
+        latency=options.latency_ms / 1000,
+        bandwidth=options.bandwidth_mb * 1024 * 1024,
+        flood_every=options.flood_every,
+        flood_seconds=options.flood_seconds
+    )
+
+    work_dir = tempfile.mkdtemp(prefix="tg_benchmark_")
+    try:
+        config = {
+            "api_id": "1",
+            "api_hash": "benchmark",
+            "phone_number": "",
+            "session_path": os.path.join(work_dir, "benchmark"),
+            "search_query": BENCHMARK_QUERY,
+            "images_path": os.path.join(work_dir, "images"),
+            "archives_path": os.path.join(work_dir, "archives"),
+            "dialog_cache_ttl": 0,
+            # The generated archives are not real zip files; hashing still runs
+            "verify_archives": False
+        }
+        config.update(engine_overrides or {})
+        engine = ScraperEngine(config, log_callback=log_callback, client=client)
+
+        if options.trace_memory:
+            tracemalloc.start()
+        started = time.perf_counter()
+        await engine.run()
+        elapsed = time.perf_counter() - started
+        traced_peak = tracemalloc.get_traced_memory()[1] if options.trace_memory else None
+        if options.trace_memory:
+            tracemalloc.stop()
+
+        files = engine.downloaded_images + engine.downloaded_archives
+        written = directory_bytes(config["images_path"]) + directory_bytes(config["archives_path"])
+        return {
+            "elapsed_seconds": round(elapsed, 3),
+            "images": engine.downloaded_images,
+            "archives": engine.downloaded_archives,
+            "failed": engine.failed_downloads,
+            "expected_files": options.dialogs * options.pairs * 2,
+            "files_per_second": round(files / elapsed, 2) if elapsed else None,
+            "mb_per_second": round(written / elapsed / (1024 * 1024), 2) if elapsed else None,
+            "bytes_written": written,
+            "rpc_counts": dict(sorted(client.rpc_counts.items())),
+            "rpc_total": sum(client.rpc_counts.values()),
+            "flood_waits": client.flood_waits,
+            "peak_rss_bytes": peak_memory_bytes(),
+            "peak_traced_bytes": traced_peak,
+            "rpc_latency": engine.metrics.snapshot()["rpc"],
+            "slowest_dialogs": engine.metrics.snapshot()["dialog_seconds"][:5]
+        }
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+def legacy_parse_caption(file_name):
+    """The per-caption regex parsing the engine used before caption_parser, kept as the baseline"""
+    def sanitize(name):
+        name = re.sub(r'[.-]', ' ', name)
+        name = re.sub(r'[<>:"/\\|?*\n\r]', '', name)
+        return name.strip()
+
+    file_name = file_name.strip()
+    match = re.match(r'^([^\s]+)\s+([\s\S]+)$', file_name)
+    if not match:
+        return None, sanitize(file_name)
+    code = match.group(1)
+    description = re.sub(r'#.*', '', match.group(2).strip(), flags=re.DOTALL).strip()
+    description = sanitize(re.sub(r'\s+', ' ', description))
+    if len(code) < 3 or "*" in code:
+        code = None
+    return code, description
+
+
+def generate_captions(count, seed=1):
+    """Captions shaped like real posts: code, description with punctuation, hashtags, odd lines"""
+    rng = random.Random(seed)
+    words = ["Summer", "pack", "v2.1", "high-res", "photo", "set", "4K", "edition", "final", "bonus", "a/b", "x:y"]
+    captions = []
+    for index in range(count):
+        shape = index % 10
+        code = f"C{rng.randrange(10 ** 6):06d}"
+        description = " ".join(rng.choice(words) for _ in range(rng.randrange(2, 9)))
+        if shape == 0:
+            captions.append(code)
+        elif shape == 1:
+            captions.append(f"**{code}** {description}")
+        elif shape == 2:
+            captions.append(f"{code}\n{description}\n\n#tag #{rng.choice(words)}")
+        else:
+            captions.append(f"{code}  {description} - {rng.choice(words)}. #sample")
+    return captions
+
+
+def run_caption_benchmark(count, repeats=3):
+    """Time the legacy and the compiled caption parsing over the same captions"""
+    captions = generate_captions(count)
+    parser = CaptionParser()
+    expected = [legacy_parse_caption(caption) for caption in captions]
+    if parser.parse_many(captions) != expected:
+        raise AssertionError("caption_parser output differs from the legacy parsing")
+
+    def best_of(parse):
+        timings = []
+        for _ in range(repeats):
+            started = time.perf_counter()
+            parse()
+            timings.append(time.perf_counter() - started)
+        return min(timings)
+
+    legacy = best_of(lambda: [legacy_parse_caption(caption) for caption in captions])
+    compiled = best_of(lambda: parser.parse_many(captions))
+    return {
+        "captions": count,
+        "legacy_per_second": round(count / legacy),
+        "compiled_per_second": round(count / compiled),
+        "speedup": round(legacy / compiled, 2)
+    }
+
+
+# Engine settings that can be varied between benchmark runs, keyed by config.json setting
+ENGINE_FLAGS = {
+    "max_concurrent_downloads": ("--max-concurrent-downloads", int),
+    "max_parallel_parts": ("--max-parallel-parts", int),
+    "chunk_size": ("--chunk-size", int),
+    "dialog_parallelism": ("--dialog-parallelism", int),
+    "search_requests_per_second": ("--search-rps", float),
+    "file_requests_per_second": ("--file-rps", float),
+    "image_quality": ("--image-quality", str)
+}
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(prog="benchmark", description="Measure the download pipeline against a simulated Telegram")
+    parser.add_argument("--dialogs", type=int, default=10, help="number of simulated channels")
+    parser.add_argument("--pairs", type=int, default=20, help="image/archive pairs per channel")
+    parser.add_argument("--image-kb", type=int, default=200, help="size of each image")
+    parser.add_argument("--archive-mb", type=float, default=4, help="size of each archive")
+    parser.add_argument("--latency-ms", type=float, default=50, help="round trip time of every request")
+    parser.add_argument("--bandwidth-mb", type=float, default=0, help="MB/s of a single request stream, 0 for unlimited")
+    parser.add_argument("--flood-every", type=int, default=0, help="answer every Nth request with a FloodWait, 0 for never")
+    parser.add_argument("--flood-seconds", type=int, default=1, help="length of each injected FloodWait")
+    parser.add_argument("--trace-memory", action="store_true", help="also report the peak of Python allocations (slower)")
+    parser.add_argument("--verbose", action="store_true", help="print the engine log")
+    parser.add_argument("--json", action="store_true", help="print the results as JSON")
+    parser.add_argument("--captions", type=int, metavar="N", help="only benchmark caption parsing over N captions")
+    for key, (flag, flag_type) in ENGINE_FLAGS.items():
+        parser.add_argument(flag, dest=key, type=flag_type, help=f"engine setting {key}")
+    return parser
+
+
+def format_results(results):
+    lines = [
+        f"Elapsed:      {results['elapsed_seconds']} s",
+        f"Files:        {results['images']} images + {results['archives']} archives "
+        f"of {results['expected_files']} ({results['failed']} failed)",
+        f"Throughput:   {results['files_per_second']} files/s | {results['mb_per_second']} MB/s",
+        f"RPCs:         {results['rpc_total']} total, {results['flood_waits']} FloodWaits",
+    ]
+    lines += [
+        f"  {method}: {stats['count']} (avg {stats['avg'] * 1000:.1f} ms, "
+        f"{stats['flood_waits']} FloodWaits / {stats['flood_wait_seconds']} s)"
+        for method, stats in results["rpc_latency"].items()
+    ]
+    if results["peak_rss_bytes"] is not None:
+        lines.append(f"Peak RSS:     {results['peak_rss_bytes'] / (1024 * 1024):.1f} MB")
+    if results["peak_traced_bytes"] is not None:
+        lines.append(f"Peak traced:  {results['peak_traced_bytes'] / (1024 * 1024):.1f} MB")
+    return "\n".join(lines)
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    if args.captions:
+        results = run_caption_benchmark(args.captions)
+        print(json.dumps(results, indent=2) if args.json else (
+            f"Captions:  {results['captions']}\n"
+            f"Legacy:    {results['legacy_per_second']} captions/s\n"
+            f"Compiled:  {results['compiled_per_second']} captions/s ({results['speedup']}x)"
+        ))
+        return 0
+
+    overrides = {key: getattr(args, key) for key in ENGINE_FLAGS if getattr(args, key) is not None}
+    results = asyncio.run(run_benchmark(args, overrides, log_callback=print if args.verbose else None))
+    print(json.dumps(results, indent=2) if args.json else format_results(results))
+    return 0 if results["failed"] == 0 else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,119 @@
+import os
+import re
+
+# Archive formats recognised by file name, lower case
+ARCHIVE_EXTENSIONS = ('.rar', '.zip', '.7z', '.tar', '.gz', '.bz2')
+
+# How the code is taken from the start of a caption
+CODE_RULE_MODES = ("first_token", "regex", "prefix")
+
+DEFAULT_CODE_RULE = {
+    "mode": "first_token",
+    # regex mode: the named group "code" (or else the first group, or else the whole match) is the code
+    "pattern": "",
+    # prefix mode: the first length characters are the code
+    "length": 0,
+    "min_length": 3,
+    "forbidden_chars": "*"
+}
+
+# Dots and dashes become spaces; characters that are not allowed in file names are dropped
+SANITIZE_TABLE = str.maketrans({'.': ' ', '-': ' ', **{char: None for char in '<>:"/\\|?*\n\r'}})
+
+# Word separators for index keys: punctuation and underscores, so P0003-final.zip and #P0003 yield P0003
+KEY_SEPARATORS = re.compile(r'[\W_]+')
+
+
+def sanitize_filename(name):
+    """Sanitize filename for filesystem compatibility"""
+    return name.translate(SANITIZE_TABLE).strip()
+
+
+def clean_description(text):
+    """Cut the caption at its first hashtag, collapse whitespace and sanitize"""
+    return sanitize_filename(" ".join(text.split("#", 1)[0].split()))
+
+
+def is_archive(file_name):
+    """Check if file is an archive"""
+    return bool(file_name) and file_name.lower().endswith(ARCHIVE_EXTENSIONS)
+
+
+def archive_key(text):
+    """Return the form an index key is stored and looked up in; matching ignores case like Telegram's search"""
+    return text.casefold()
+
+
+def archive_index_keys(file_name, caption):
+    """Return the tokens an archive can be looked up by (file name stem and caption words)
+
+    Whitespace tokens keep codes that contain punctuation; their parts between punctuation are keys too,
+    as Telegram's word search would find them. Empty for files that are not archives, so callers test
+    and tokenize in one call"""
+    if not is_archive(file_name):
+        return set()
+    tokens = os.path.splitext(file_name)[0].split()
+    if caption:
+        tokens += caption.split()
+    keys = set(tokens)
+    for token in tokens:
+        keys.update(part for part in KEY_SEPARATORS.split(token) if part)
+    return {archive_key(key) for key in keys}
+
+
+class CaptionParser:
+    """Extracts (code, clean name) from captions using rules compiled once per run"""
+    def __init__(self, rule=None):
+        rule = dict(DEFAULT_CODE_RULE, **(rule or {}))
+        mode = rule["mode"]
+        if mode not in CODE_RULE_MODES:
+            raise ValueError(f"Unknown code rule mode: {mode}")
+
+        self.min_length = int(rule["min_length"])
+        self.forbidden_chars = frozenset(rule["forbidden_chars"])
+        if mode == "regex":
+            try:
+                self.pattern = re.compile(rule["pattern"])
+            except re.error as e:
+                raise ValueError(f"Invalid code pattern: {e}")
+            self.code_group = "code" if "code" in self.pattern.groupindex else (1 if self.pattern.groups else 0)
+            self.split = self._split_regex
+        elif mode == "prefix":
+            self.length = int(rule["length"])
+            if self.length < 1:
+                raise ValueError("Code rule prefix length must be at least 1")
+            self.split = self._split_prefix
+        else:
+            self.split = self._split_first_token
+
+    @staticmethod
+    def _split_first_token(text):
+        parts = text.split(None, 1)
+        return (parts[0], parts[1]) if len(parts) == 2 else (None, text)
+
+    def _split_prefix(self, text):
+        code, rest = text[:self.length], text[self.length:]
+        return (code, rest) if len(code) == self.length and rest.strip() else (None, text)
+
+    def _split_regex(self, text):
+        match = self.pattern.search(text)
+        if not match or not match.group(self.code_group):
+            return None, text
+        # Everything around the matched code is the description
+        return match.group(self.code_group), text[:match.start()] + " " + text[match.end():]
+
+    def is_valid_code(self, code):
+        return bool(code) and len(code) >= self.min_length and not self.forbidden_chars.intersection(code)
+
+    def parse(self, text):
+        """Return (code, clean name); code is None when the caption has no usable code"""
+        text = text.strip()
+        code, description = self.split(text)
+        if code is None:
+            return None, sanitize_filename(text)
+        return (code if self.is_valid_code(code) else None), clean_description(description)
+
+    def parse_many(self, texts):
+        """Parse a page of captions in one pass"""
+        parse = self.parse
+        return [parse(text) for text in texts]
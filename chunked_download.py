@@ -0,0 +1,220 @@
+import asyncio
+import json
+import os
+import time
+
+from telethon import errors
+
+from disk_space import preallocate
+from rate_limiter import FILE_REQUESTS
+
+# Telegram serves file parts in requests of at most 512 KB; offsets must stay aligned to it
+REQUEST_SIZE = 512 * 1024
+
+# How many byte ranges of a single file are fetched at the same time
+DEFAULT_PARTS_PER_FILE = 4
+
+# Unfinished downloads live next to their target until they are complete
+PART_SUFFIX = ".part"
+JOURNAL_SUFFIX = ".json"
+
+# Finished parts are synced to disk together at most this often, instead of one fsync per part
+SYNC_INTERVAL = 2.0
+
+
+def part_path_for(file_path):
+    """Return the temporary path a download is written to before it is complete"""
+    return file_path + PART_SUFFIX
+
+
+def finalize_part(part_path, file_path, expected_size):
+    """Move a finished .part file into place once its size matches the expected size"""
+    actual_size = os.path.getsize(part_path)
+    if expected_size and actual_size != expected_size:
+        raise IOError(f"Downloaded {actual_size} bytes, expected {expected_size}")
+    os.replace(part_path, file_path)
+
+
+class DownloadJournal:
+    """Sidecar record of the byte ranges of a .part file that are already on disk"""
+    def __init__(self, path, file_size, part_size, sync_interval=SYNC_INTERVAL):
+        self.path = path
+        self.file_size = file_size
+        self.part_size = part_size
+        self.done_parts = set()
+        # Parts written since the last fsync; the journal only claims them once they are on disk
+        self.unsynced_parts = set()
+        self.sync_interval = sync_interval
+        self.synced_at = time.monotonic()
+
+    @property
+    def bytes_completed(self):
+        return sum(min(self.part_size, self.file_size - index * self.part_size) for index in self.done_parts)
+
+    def load(self):
+        """Restore completed parts if the journal describes the same file layout"""
+        try:
+            with open(self.path, 'r') as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return False
+
+        if data.get("file_size") != self.file_size or data.get("part_size") != self.part_size:
+            return False
+
+        self.done_parts = set(data.get("done_parts", []))
+        return True
+
+    def mark_written(self, index, f):
+        """Note a finished part, syncing it together with the others once sync_interval has passed"""
+        self.unsynced_parts.add(index)
+        if time.monotonic() - self.synced_at >= self.sync_interval:
+            self.sync(f)
+
+    def sync(self, f):
+        """Flush and fsync the .part file, then record every part written since the last sync"""
+        self.synced_at = time.monotonic()
+        if not self.unsynced_parts:
+            return
+        f.flush()
+        os.fsync(f.fileno())
+        self.done_parts.update(self.unsynced_parts)
+        self.unsynced_parts.clear()
+        self.save()
+
+    def save(self):
+        data = {
+            "file_size": self.file_size,
+            "part_size": self.part_size,
+            "bytes_completed": self.bytes_completed,
+            "done_parts": sorted(self.done_parts)
+        }
+        # Write a temporary file first so a crash never leaves a half-written journal
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump(data, f)
+        os.replace(tmp_path, self.path)
+
+    def remove(self):
+        try:
+            os.remove(self.path)
+        except OSError:
+            pass
+
+
+class ChunkedDownloader:
+    """Download documents as several concurrent byte ranges written in place"""
+    def __init__(self, client, part_size, max_inflight_parts, parts_per_file=DEFAULT_PARTS_PER_FILE, rate_limiter=None):
+        self.client = client
+        self.rate_limiter = rate_limiter
+        # Round the configured chunk size to whole requests so every range starts aligned
+        self.part_size = max(REQUEST_SIZE, part_size - part_size % REQUEST_SIZE)
+        self.parts_per_file = max(1, parts_per_file)
+        # Shared by every file so the total number of in-flight parts stays bounded
+        self.part_semaphore = asyncio.Semaphore(max(1, max_inflight_parts))
+
+    async def download(self, message, file_path, progress_callback=None, max_pause=None):
+        """Download the document of a message into file_path, resuming an earlier .part file
+
+        progress_callback(received_bytes, total_bytes) is called after every written chunk. A FloodWait pause
+        of max_pause seconds or more raises SessionThrottled, leaving the .part file for another client to resume"""
+        file_size = message.file.size
+        part_count = max(1, -(-file_size // self.part_size))
+        part_path = part_path_for(file_path)
+        journal = DownloadJournal(part_path + JOURNAL_SUFFIX, file_size, self.part_size)
+
+        resumed = (
+            os.path.exists(part_path)
+            and os.path.getsize(part_path) == file_size
+            and journal.load()
+        )
+        if not resumed:
+            open(part_path, 'wb').close()
+            journal.done_parts = set()
+            journal.save()
+
+        received = journal.bytes_completed
+        
+        def on_chunk(length):
+            nonlocal received
+            received += length
+            if progress_callback:
+                progress_callback(received, file_size)
+        
+        # Completed parts stay in the .part file and journal if this download is interrupted
+        with open(part_path, 'r+b') as f:
+            # Claim the whole file up front, so each range can be written at its offset and a full
+            # volume fails here rather than halfway through the transfer
+            preallocate(f, file_size)
+            pending_parts = iter([index for index in range(part_count) if index not in journal.done_parts])
+            workers = [
+                asyncio.ensure_future(self._range_worker(message, f, pending_parts, file_size, journal, on_chunk, max_pause))
+                for _ in range(min(self.parts_per_file, part_count))
+            ]
+            try:
+                await asyncio.gather(*workers)
+            except BaseException:
+                # Keep what is on disk; parts written after a failed sync are fetched again on resume
+                try:
+                    journal.sync(f)
+                except OSError:
+                    pass
+                raise
+            finally:
+                for worker in workers:
+                    worker.cancel()
+                await asyncio.gather(*workers, return_exceptions=True)
+            journal.sync(f)
+
+        finalize_part(part_path, file_path, file_size)
+        journal.remove()
+        return file_path
+
+    async def _range_worker(self, message, f, pending_parts, file_size, journal, on_chunk, max_pause):
+        # The iterator is shared between the workers of one file; each takes the next free part
+        for index in pending_parts:
+            async with self.part_semaphore:
+                await self._download_part(message, f, index, file_size, on_chunk, max_pause)
+            # The journal may only claim bytes that have reached the disk
+            journal.mark_written(index, f)
+
+    async def _download_part(self, message, f, index, file_size, on_chunk, max_pause):
+        offset = index * self.part_size
+        end = offset + min(self.part_size, file_size - offset)
+        position = offset
+
+        while position < end:
+            start = position
+            try:
+                await self._acquire(max_pause)
+                # Every chunk is one request, so each further chunk needs a token of its own
+                async for chunk in self.client.iter_download(
+                    message.document,
+                    offset=position,
+                    limit=-(-(end - position) // REQUEST_SIZE),
+                    request_size=REQUEST_SIZE,
+                    file_size=file_size
+                ):
+                    # seek + write has no await in between, so ranges never interleave
+                    f.seek(position)
+                    f.write(chunk)
+                    position += len(chunk)
+                    on_chunk(len(chunk))
+                    if position < end:
+                        await self._acquire(max_pause)
+            except errors.FloodWaitError as e:
+                # Whole requests were written, so the part continues from an aligned position
+                if self.rate_limiter is None:
+                    raise
+                self.rate_limiter.on_flood_wait(FILE_REQUESTS, e.seconds)
+                continue
+
+            if position == start:
+                break
+
+        if position != end:
+            raise IOError(f"Part {index} ended at byte {position}, expected {end}")
+
+    async def _acquire(self, max_pause=None):
+        if self.rate_limiter is not None:
+            await self.rate_limiter.acquire(FILE_REQUESTS, max_pause)
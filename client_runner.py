@@ -0,0 +1,53 @@
+import asyncio
+import threading
+
+from scraper_engine import create_client
+
+
+class ClientRunner:
+    """Background event loop thread that owns one long-lived Telegram client"""
+    def __init__(self):
+        self.loop = asyncio.new_event_loop()
+        self.client = None
+        self.client_key = None
+        self.thread = threading.Thread(target=self._run_loop, name="telegram-client", daemon=True)
+        self.thread.start()
+
+    def _run_loop(self):
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_forever()
+
+    def submit(self, coro):
+        """Schedule a coroutine on the client loop from any thread; returns a concurrent Future"""
+        return asyncio.run_coroutine_threadsafe(coro, self.loop)
+
+    async def get_client(self, config):
+        """Return the shared client connected, recreating it if the session or credentials changed"""
+        key = (config["session_path"], str(config["api_id"]), config["api_hash"])
+        if self.client is not None and key != self.client_key:
+            await self.drop_client()
+
+        if self.client is None:
+            self.client = create_client(config)
+            self.client_key = key
+
+        # Reconnecting an existing client reuses its auth key and known data centers
+        if not self.client.is_connected():
+            await self.client.connect()
+        return self.client
+
+    async def drop_client(self):
+        """Disconnect and forget the shared client, e.g. before its session file is replaced"""
+        if self.client is not None:
+            await self.client.disconnect()
+        self.client = None
+        self.client_key = None
+
+    def stop(self, timeout=5):
+        """Disconnect the client and stop the loop thread"""
+        try:
+            self.submit(self.drop_client()).result(timeout)
+        except Exception:
+            pass
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join(timeout)
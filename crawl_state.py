@@ -0,0 +1,232 @@
+import sqlite3
+import time
+
+# Pseudo-query under which the archive index scan records its progress. Renamed when the keys change,
+# so stores indexed with the old keys scan their documents once more
+ARCHIVE_SCAN_QUERY = "<archives:casefold>"
+
+# Pseudo-query of the scan that mirrors every photo of a dialog
+PHOTO_SCAN_QUERY = "<photos>"
+
+# image_done of a code whose image was only recorded as metadata, without fetching it
+IMAGE_PREVIEW_ONLY = 2
+
+
+def state_path_for(session_path):
+    """Return the state database path that belongs to a session file"""
+    return session_path + ".state.db"
+
+
+class CrawlState:
+    """SQLite store of scan watermarks, handled codes and indexed archives"""
+    def __init__(self, path):
+        self.path = path
+        self.conn = sqlite3.connect(path)
+        self.conn.executescript("""
+            CREATE TABLE IF NOT EXISTS scan_progress (
+                dialog_id INTEGER NOT NULL,
+                query TEXT NOT NULL,
+                max_id INTEGER NOT NULL,
+                updated_at REAL NOT NULL,
+                PRIMARY KEY (dialog_id, query)
+            );
+            CREATE TABLE IF NOT EXISTS scan_cursors (
+                dialog_id INTEGER NOT NULL,
+                query TEXT NOT NULL,
+                min_id INTEGER NOT NULL,
+                offset_id INTEGER NOT NULL,
+                max_id INTEGER NOT NULL,
+                PRIMARY KEY (dialog_id, query)
+            );
+            CREATE TABLE IF NOT EXISTS codes (
+                code TEXT PRIMARY KEY,
+                clean_name TEXT NOT NULL,
+                image_dialog_id INTEGER,
+                image_message_id INTEGER,
+                image_done INTEGER NOT NULL DEFAULT 0,
+                archive_dialog_id INTEGER,
+                archive_message_id INTEGER,
+                updated_at REAL NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS archive_keys (
+                key TEXT PRIMARY KEY,
+                dialog_id INTEGER NOT NULL,
+                message_id INTEGER NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS media_catalog (
+                media_type TEXT NOT NULL,
+                media_id INTEGER NOT NULL,
+                access_hash INTEGER,
+                size INTEGER,
+                path TEXT NOT NULL,
+                sha256 TEXT,
+                PRIMARY KEY (media_type, media_id)
+            );
+            CREATE INDEX IF NOT EXISTS media_catalog_sha256 ON media_catalog (sha256);
+            CREATE INDEX IF NOT EXISTS media_catalog_path ON media_catalog (path);
+        """)
+        self.conn.commit()
+
+    def close(self):
+        self.conn.close()
+
+    # Scan watermarks
+
+    def get_max_id(self, dialog_id, query):
+        """Return the highest message id already scanned for a dialog and query"""
+        row = self.conn.execute(
+            "SELECT max_id FROM scan_progress WHERE dialog_id = ? AND query = ?",
+            (dialog_id, query)
+        ).fetchone()
+        return row[0] if row else 0
+
+    def set_max_id(self, dialog_id, query, max_id):
+        self.conn.execute(
+            "INSERT INTO scan_progress (dialog_id, query, max_id, updated_at) VALUES (?, ?, ?, ?) "
+            "ON CONFLICT(dialog_id, query) DO UPDATE SET "
+            "max_id = MAX(max_id, excluded.max_id), updated_at = excluded.updated_at",
+            (dialog_id, query, max_id, time.time())
+        )
+        self.conn.commit()
+
+    # Cursors of interrupted scans
+
+    def get_cursor(self, dialog_id, query):
+        """Return (min_id, offset_id, max_id) of a scan that stopped part way, or None"""
+        return self.conn.execute(
+            "SELECT min_id, offset_id, max_id FROM scan_cursors WHERE dialog_id = ? AND query = ?",
+            (dialog_id, query)
+        ).fetchone()
+
+    def set_cursor(self, dialog_id, query, min_id, offset_id, max_id):
+        """Record that a scan down to min_id has handled every message from max_id down to offset_id"""
+        self.conn.execute(
+            "INSERT OR REPLACE INTO scan_cursors (dialog_id, query, min_id, offset_id, max_id) VALUES (?, ?, ?, ?, ?)",
+            (dialog_id, query, min_id, offset_id, max_id)
+        )
+        self.conn.commit()
+
+    def clear_cursor(self, dialog_id, query):
+        self.conn.execute("DELETE FROM scan_cursors WHERE dialog_id = ? AND query = ?", (dialog_id, query))
+        self.conn.commit()
+
+    # Codes
+
+    def known_codes(self):
+        """Return every code that has been seen, finished or not"""
+        return {row[0] for row in self.conn.execute("SELECT code FROM codes")}
+
+    def unfinished_codes(self, include_previews=False):
+        """Return (code, clean_name, image dialog, image message, image_done, archive_done) for codes still missing files
+
+        include_previews also counts images that were only recorded as metadata as missing"""
+        return self.conn.execute(
+            "SELECT code, clean_name, image_dialog_id, image_message_id, image_done, "
+            "archive_message_id IS NOT NULL FROM codes "
+            "WHERE image_done = 0 OR archive_message_id IS NULL OR (? AND image_done = ?)",
+            (include_previews, IMAGE_PREVIEW_ONLY)
+        ).fetchall()
+
+    def codes_missing_archive(self):
+        """Return {code: clean_name} for every code whose archive has not been downloaded"""
+        return dict(self.conn.execute("SELECT code, clean_name FROM codes WHERE archive_message_id IS NULL"))
+
+    def code_statuses(self, codes):
+        """Return {code: "done" or "unfinished"} for the given codes that have been seen; unseen codes are left out"""
+        statuses = {}
+        for code, image_done, archive_message_id in self.conn.execute(
+            f"SELECT code, image_done, archive_message_id FROM codes WHERE code IN ({', '.join('?' * len(codes))})",
+            list(codes)
+        ):
+            statuses[code] = "done" if image_done and archive_message_id is not None else "unfinished"
+        return statuses
+
+    def add_code(self, code, clean_name, dialog_id, message_id):
+        self.conn.execute(
+            "INSERT OR IGNORE INTO codes (code, clean_name, image_dialog_id, image_message_id, updated_at) "
+            "VALUES (?, ?, ?, ?, ?)",
+            (code, clean_name, dialog_id, message_id, time.time())
+        )
+        self.conn.commit()
+
+    def mark_image_done(self, code, preview_only=False):
+        self.conn.execute(
+            "UPDATE codes SET image_done = ?, updated_at = ? WHERE code = ?",
+            (IMAGE_PREVIEW_ONLY if preview_only else 1, time.time(), code)
+        )
+        self.conn.commit()
+
+    def mark_archive_done(self, code, dialog_id, message_id):
+        self.conn.execute(
+            "UPDATE codes SET archive_dialog_id = ?, archive_message_id = ?, updated_at = ? WHERE code = ?",
+            (dialog_id, message_id, time.time(), code)
+        )
+        self.conn.commit()
+
+    def reset_download(self, code, kind):
+        """Mark the image or archive of a code as missing again, e.g. after it failed verification"""
+        if kind == "image":
+            sql = "UPDATE codes SET image_done = 0, updated_at = ? WHERE code = ?"
+        else:
+            sql = "UPDATE codes SET archive_dialog_id = NULL, archive_message_id = NULL, updated_at = ? WHERE code = ?"
+        self.conn.execute(sql, (time.time(), code))
+        self.conn.commit()
+
+    # Archive index
+
+    def add_archive_keys(self, entries):
+        """Store (key, dialog_id, message_id) entries; newer scans replace older ones
+
+        Within one dialog the newest message keeps the key, as scans store their pages newest first"""
+        self.conn.executemany(
+            "INSERT INTO archive_keys (key, dialog_id, message_id) VALUES (?, ?, ?) "
+            "ON CONFLICT(key) DO UPDATE SET dialog_id = excluded.dialog_id, message_id = excluded.message_id "
+            "WHERE archive_keys.dialog_id != excluded.dialog_id OR archive_keys.message_id < excluded.message_id",
+            entries
+        )
+        self.conn.commit()
+
+    def find_archive(self, key):
+        """Return (dialog_id, message_id) of an archive indexed in an earlier run, or None
+
+        key is an archive_key(), as the keys are stored"""
+        return self.conn.execute(
+            "SELECT dialog_id, message_id FROM archive_keys WHERE key = ?",
+            (key,)
+        ).fetchone()
+
+    # Media catalog
+
+    def find_media(self, media_type, media_id):
+        """Return the path a Telegram photo/document was saved to, or None"""
+        row = self.conn.execute(
+            "SELECT path FROM media_catalog WHERE media_type = ? AND media_id = ?",
+            (media_type, media_id)
+        ).fetchone()
+        return row[0] if row else None
+
+    def find_by_hash(self, sha256):
+        """Return the paths of completed files with this content hash"""
+        return [row[0] for row in self.conn.execute(
+            "SELECT path FROM media_catalog WHERE sha256 = ?",
+            (sha256,)
+        )]
+
+    def path_owner(self, path):
+        """Return (media_type, media_id) of the media saved at path, or None"""
+        return self.conn.execute(
+            "SELECT media_type, media_id FROM media_catalog WHERE path = ?",
+            (path,)
+        ).fetchone()
+
+    def remove_media(self, path):
+        self.conn.execute("DELETE FROM media_catalog WHERE path = ?", (path,))
+        self.conn.commit()
+
+    def add_media(self, media_type, media_id, access_hash, size, path, sha256):
+        self.conn.execute(
+            "INSERT OR REPLACE INTO media_catalog (media_type, media_id, access_hash, size, path, sha256) "
+            "VALUES (?, ?, ?, ?, ?, ?)",
+            (media_type, media_id, access_hash, size, path, sha256)
+        )
+        self.conn.commit()
@@ -0,0 +1,159 @@
+import json
+import os
+import time
+
+from telethon import utils
+from telethon.tl.types import InputPeerChannel, InputPeerChat, InputPeerSelf, InputPeerUser
+
+# Dialog types that can be named in the "types" filter
+DIALOG_TYPES = ("channel", "group", "user", "bot")
+
+DEFAULT_DIALOG_FILTERS = {
+    "allow_ids": [],
+    "deny_ids": [],
+    "allow_usernames": [],
+    "deny_usernames": [],
+    "types": [],
+    "active_within_days": 0
+}
+
+
+def dialog_cache_path_for(session_path):
+    """Return the dialog cache path that belongs to a session file"""
+    return session_path + ".dialogs.json"
+
+
+class CachedDialog:
+    """The parts of a Telegram dialog the scanners need, restorable without any request"""
+    def __init__(self, id, name, type, username, last_activity, entity):
+        self.id = id
+        self.name = name
+        self.type = type
+        self.username = username
+        self.last_activity = last_activity
+        self.entity = entity
+
+    @classmethod
+    def from_dialog(cls, dialog):
+        entity = dialog.entity
+        if dialog.is_user:
+            dialog_type = "bot" if getattr(entity, 'bot', False) else "user"
+        elif dialog.is_group:
+            dialog_type = "group"
+        else:
+            dialog_type = "channel"
+
+        return cls(
+            dialog.id,
+            dialog.name,
+            dialog_type,
+            getattr(entity, 'username', None),
+            dialog.date.timestamp() if dialog.date else 0,
+            utils.get_input_peer(entity)
+        )
+
+    def to_dict(self):
+        return {
+            "id": self.id,
+            "name": self.name,
+            "type": self.type,
+            "username": self.username,
+            "last_activity": self.last_activity,
+            "peer": peer_to_dict(self.entity)
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(
+            data["id"],
+            data["name"],
+            data["type"],
+            data.get("username"),
+            data.get("last_activity", 0),
+            peer_from_dict(data["peer"])
+        )
+
+
+def peer_to_dict(peer):
+    if isinstance(peer, InputPeerChannel):
+        return {"type": "channel", "id": peer.channel_id, "access_hash": peer.access_hash}
+    if isinstance(peer, InputPeerChat):
+        return {"type": "chat", "id": peer.chat_id}
+    if isinstance(peer, InputPeerUser):
+        return {"type": "user", "id": peer.user_id, "access_hash": peer.access_hash}
+    return {"type": "self"}
+
+
+def peer_from_dict(data):
+    if data["type"] == "channel":
+        return InputPeerChannel(channel_id=data["id"], access_hash=data["access_hash"])
+    if data["type"] == "chat":
+        return InputPeerChat(chat_id=data["id"])
+    if data["type"] == "user":
+        return InputPeerUser(user_id=data["id"], access_hash=data["access_hash"])
+    return InputPeerSelf()
+
+
+class DialogCache:
+    """Dialog list cached on disk between runs and refreshed after a TTL"""
+    def __init__(self, path, ttl):
+        self.path = path
+        self.ttl = ttl
+
+    def load(self):
+        """Return the cached dialogs, or None if there is no fresh cache"""
+        if self.ttl <= 0:
+            return None
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return None
+
+        if time.time() - data.get("fetched_at", 0) > self.ttl:
+            return None
+        try:
+            return [CachedDialog.from_dict(entry) for entry in data.get("dialogs", [])]
+        except (KeyError, TypeError):
+            return None
+
+    def save(self, dialogs):
+        data = {
+            "fetched_at": time.time(),
+            "dialogs": [dialog.to_dict() for dialog in dialogs]
+        }
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(data, f, ensure_ascii=False)
+        os.replace(tmp_path, self.path)
+
+
+def filter_dialogs(dialogs, filters):
+    """Apply the allow/deny, type and last-activity filters from the config"""
+    filters = dict(DEFAULT_DIALOG_FILTERS, **(filters or {}))
+
+    def normalize(username):
+        return (username or "").lstrip("@").lower()
+
+    allow_ids = {int(dialog_id) for dialog_id in filters["allow_ids"]}
+    deny_ids = {int(dialog_id) for dialog_id in filters["deny_ids"]}
+    allow_usernames = {normalize(username) for username in filters["allow_usernames"]}
+    deny_usernames = {normalize(username) for username in filters["deny_usernames"]}
+    types = set(filters["types"])
+    cutoff = time.time() - float(filters["active_within_days"]) * 86400 if filters["active_within_days"] else None
+
+    selected = []
+    for dialog in dialogs:
+        username = normalize(dialog.username)
+        if dialog.id in deny_ids or (username and username in deny_usernames):
+            continue
+        if (allow_ids or allow_usernames) and not (
+            dialog.id in allow_ids or (username and username in allow_usernames)
+        ):
+            continue
+        if types and dialog.type not in types:
+            continue
+        if cutoff is not None and dialog.last_activity < cutoff:
+            continue
+        selected.append(dialog)
+    return selected
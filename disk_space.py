@@ -0,0 +1,95 @@
+import asyncio
+import errno
+import os
+import shutil
+
+MB = 1024 * 1024
+
+# Write errors that mean the volume cannot take any more data
+DISK_FULL_ERRORS = (errno.ENOSPC, errno.EDQUOT)
+
+
+def is_disk_full(error):
+    return isinstance(error, OSError) and error.errno in DISK_FULL_ERRORS
+
+
+def preallocate(f, size):
+    """Reserve size bytes for an open file, so a full volume fails before the transfer instead of during it"""
+    if hasattr(os, "posix_fallocate"):
+        try:
+            os.posix_fallocate(f.fileno(), 0, size)
+            return
+        except OSError as e:
+            if is_disk_full(e):
+                raise
+            # Filesystems without fallocate support get a sparse file, as on Windows
+    f.seek(0, os.SEEK_END)
+    if f.tell() < size:
+        f.truncate(size)
+
+
+def allocated_bytes(path):
+    """Return the bytes a file already occupies on disk; holes of a sparse file do not count"""
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return 0
+    blocks = getattr(stat, "st_blocks", None)
+    return blocks * 512 if blocks is not None else stat.st_size
+
+
+class DiskFull(OSError):
+    """A download cannot fit on its volume even with nothing else in flight"""
+
+
+class DiskSpace:
+    """Admits downloads only while their volume has room for them and for everything still in flight"""
+    def __init__(self, min_free_bytes=0, poll_interval=5.0, log_callback=None):
+        self.min_free_bytes = min_free_bytes
+        # Space can also be freed outside this process, so waiters look again after poll_interval
+        self.poll_interval = poll_interval
+        self.log_callback = log_callback
+        # Path being written -> (device, expected size)
+        self.reservations = {}
+        self.released = asyncio.Event()
+
+    def pending_bytes(self, device):
+        """Bytes the admitted downloads on a device will still claim, beyond what they have allocated"""
+        return sum(
+            max(0, size - allocated_bytes(path))
+            for path, (path_device, size) in self.reservations.items()
+            if path_device == device
+        )
+
+    async def reserve(self, path, size):
+        """Wait until the volume of path has room for size more bytes, then hold them until release(path)
+
+        Raises DiskFull when the file does not fit and no running download could free anything"""
+        directory = os.path.dirname(os.path.abspath(path))
+        device = os.stat(directory).st_dev
+        waiting = False
+        while True:
+            free = shutil.disk_usage(directory).free
+            # A resumed .part file was preallocated by an earlier run; only the rest still has to fit
+            needed = max(0, size - allocated_bytes(path))
+            if needed <= free - self.pending_bytes(device) - self.min_free_bytes:
+                self.reservations[path] = (device, size)
+                return
+            if not any(path_device == device for path_device, _ in self.reservations.values()):
+                raise DiskFull(
+                    errno.ENOSPC,
+                    f"needs {needed / MB:.1f} MB, {max(0, free - self.min_free_bytes) / MB:.1f} MB usable"
+                )
+            if not waiting and self.log_callback:
+                self.log_callback(f"💾 Waiting for disk space for {os.path.basename(path)}")
+            waiting = True
+            try:
+                await asyncio.wait_for(self.released.wait(), self.poll_interval)
+            except asyncio.TimeoutError:
+                pass
+
+    def release(self, path):
+        if self.reservations.pop(path, None) is not None:
+            # Wake every waiter; each checks the space again
+            self.released.set()
+            self.released = asyncio.Event()
@@ -0,0 +1,148 @@
+import sqlite3
+
+# Kinds of media the mirror keeps
+PHOTO = "photo"
+DOCUMENT = "document"
+
+# Shortest text the trigram index can look up; shorter texts scan the table
+MIN_INDEXED_LENGTH = 3
+
+COLUMNS = ("dialog_id", "message_id", "kind", "caption", "file_name", "size",
+           "media_id", "access_hash", "code", "clean_name", "date")
+
+
+def like_pattern(text):
+    """Return a LIKE pattern matching text anywhere, with the LIKE wildcards in it escaped"""
+    escaped = text.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+    return f"%{escaped}%"
+
+
+class MessageMirror:
+    """Local copy of the metadata of every photo and document the scraper has seen
+
+    Captions and file names are indexed as trigrams, so a lookup is a case-insensitive substring match,
+    like the matching watch mode does on new posts"""
+    def __init__(self, path):
+        self.path = path
+        self.conn = sqlite3.connect(path)
+        self.conn.row_factory = sqlite3.Row
+        self.conn.executescript("""
+            CREATE TABLE IF NOT EXISTS messages (
+                dialog_id INTEGER NOT NULL,
+                message_id INTEGER NOT NULL,
+                kind TEXT NOT NULL,
+                caption TEXT NOT NULL,
+                file_name TEXT NOT NULL,
+                size INTEGER,
+                media_id INTEGER,
+                access_hash INTEGER,
+                code TEXT,
+                clean_name TEXT,
+                date REAL,
+                PRIMARY KEY (dialog_id, message_id)
+            );
+            CREATE INDEX IF NOT EXISTS messages_code ON messages (code);
+            CREATE TABLE IF NOT EXISTS mirror_coverage (
+                dialog_id INTEGER PRIMARY KEY,
+                photo_max_id INTEGER NOT NULL
+            );
+        """)
+        self.conn.commit()
+        self.full_text = self.create_full_text_index()
+
+    def create_full_text_index(self):
+        """Create the trigram index and the triggers that keep it in step; False where SQLite lacks FTS5"""
+        created = self.conn.execute("SELECT 1 FROM sqlite_master WHERE name = 'messages_fts'").fetchone() is None
+        try:
+            self.conn.executescript("""
+                CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts USING fts5(
+                    caption, file_name, content='messages', content_rowid='rowid', tokenize='trigram'
+                );
+                CREATE TRIGGER IF NOT EXISTS messages_fts_insert AFTER INSERT ON messages BEGIN
+                    INSERT INTO messages_fts (rowid, caption, file_name) VALUES (new.rowid, new.caption, new.file_name);
+                END;
+                CREATE TRIGGER IF NOT EXISTS messages_fts_delete AFTER DELETE ON messages BEGIN
+                    INSERT INTO messages_fts (messages_fts, rowid, caption, file_name)
+                    VALUES ('delete', old.rowid, old.caption, old.file_name);
+                END;
+                CREATE TRIGGER IF NOT EXISTS messages_fts_update AFTER UPDATE ON messages BEGIN
+                    INSERT INTO messages_fts (messages_fts, rowid, caption, file_name)
+                    VALUES ('delete', old.rowid, old.caption, old.file_name);
+                    INSERT INTO messages_fts (rowid, caption, file_name) VALUES (new.rowid, new.caption, new.file_name);
+                END;
+            """)
+            if created:
+                # Rows stored while the index was missing
+                self.conn.execute("INSERT INTO messages_fts (messages_fts) VALUES ('rebuild')")
+            self.conn.commit()
+            return True
+        except sqlite3.OperationalError:
+            # SQLite before 3.34 has no trigram tokenizer; lookups then scan the table
+            self.conn.rollback()
+            return False
+
+    def close(self):
+        self.conn.close()
+
+    def add(self, dialog_id, entries):
+        """Store (message_id, kind, caption, file_name, size, media_id, access_hash, code, clean_name, date) entries
+
+        A code found earlier is kept when the same message is stored again without one"""
+        self.conn.executemany(
+            "INSERT INTO messages (dialog_id, message_id, kind, caption, file_name, size, media_id, access_hash, "
+            "code, clean_name, date) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?) "
+            "ON CONFLICT(dialog_id, message_id) DO UPDATE SET kind = excluded.kind, caption = excluded.caption, "
+            "file_name = excluded.file_name, size = excluded.size, media_id = excluded.media_id, "
+            "access_hash = excluded.access_hash, code = COALESCE(excluded.code, messages.code), "
+            "clean_name = COALESCE(excluded.clean_name, messages.clean_name), date = excluded.date",
+            [(dialog_id,) + tuple(entry) for entry in entries]
+        )
+        self.conn.commit()
+
+    def search(self, text, dialog_id=None, kind=None, min_id=0, max_id=None, limit=None):
+        """Return the stored messages whose caption or file name contains text, newest first
+
+        min_id is exclusive and max_id inclusive, as for a scan between two watermarks"""
+        conditions = ["message_id > ?"]
+        params = [min_id]
+        if self.full_text and len(text) >= MIN_INDEXED_LENGTH:
+            conditions.append("rowid IN (SELECT rowid FROM messages_fts WHERE messages_fts MATCH ?)")
+            # A quoted phrase of trigrams matches the text as a substring
+            params.append('"' + text.replace('"', '""') + '"')
+        else:
+            conditions.append("(caption LIKE ? ESCAPE '\\' OR file_name LIKE ? ESCAPE '\\')")
+            params += [like_pattern(text)] * 2
+        if dialog_id is not None:
+            conditions.append("dialog_id = ?")
+            params.append(dialog_id)
+        if kind is not None:
+            conditions.append("kind = ?")
+            params.append(kind)
+        if max_id is not None:
+            conditions.append("message_id <= ?")
+            params.append(max_id)
+        sql = f"SELECT {', '.join(COLUMNS)} FROM messages WHERE {' AND '.join(conditions)} ORDER BY date DESC, message_id DESC"
+        if limit:
+            sql += f" LIMIT {int(limit)}"
+        return self.conn.execute(sql, params).fetchall()
+
+    def count(self):
+        return self.conn.execute("SELECT COUNT(*) FROM messages").fetchone()[0]
+
+    # Coverage
+
+    def photo_coverage(self, dialog_id):
+        """Return the message id up to which every photo of a dialog is stored"""
+        row = self.conn.execute(
+            "SELECT photo_max_id FROM mirror_coverage WHERE dialog_id = ?",
+            (dialog_id,)
+        ).fetchone()
+        return row[0] if row else 0
+
+    def set_photo_coverage(self, dialog_id, max_id):
+        self.conn.execute(
+            "INSERT INTO mirror_coverage (dialog_id, photo_max_id) VALUES (?, ?) "
+            "ON CONFLICT(dialog_id) DO UPDATE SET photo_max_id = MAX(photo_max_id, excluded.photo_max_id)",
+            (dialog_id, max_id)
+        )
+        self.conn.commit()
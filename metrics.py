@@ -0,0 +1,284 @@
+import asyncio
+import json
+import os
+import time
+from collections import deque
+from contextlib import contextmanager
+
+from telethon import errors
+
+# Upper bounds of the RPC latency histogram, in seconds
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+# How many finished files the JSON snapshot lists with their own throughput
+RECENT_FILES = 50
+
+
+class Histogram:
+    """Cumulative latency histogram in the Prometheus layout"""
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value):
+        self.count += 1
+        self.sum += value
+        self.max = max(self.max, value)
+        for index, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[index] += 1
+
+    def to_dict(self):
+        return {
+            "count": self.count,
+            "sum": round(self.sum, 4),
+            "avg": round(self.sum / self.count, 4) if self.count else 0,
+            "max": round(self.max, 4)
+        }
+
+
+class Metrics:
+    """Counters, gauges and timing spans of one run, exported as Prometheus text or JSON"""
+    def __init__(self, spans_path=None):
+        self.started_at = time.time()
+        self.rpc_latency = {}
+        self.rpc_errors = {}
+        self.flood_waits = {}
+        self.flood_wait_seconds = {}
+        self.files = {}
+        self.bytes = {}
+        self.transfer_seconds = {}
+        self.failed = {}
+        self.active_downloads = 0
+        self.dialog_seconds = {}
+        self.recent_files = deque(maxlen=RECENT_FILES)
+        self.gauges = {}
+
+        self.spans_file = open(spans_path, 'a', encoding='utf-8') if spans_path else None
+        # (client, its own _call attribute or None) for every instrumented client
+        self.clients = []
+
+    def close(self):
+        self.release_clients()
+        if self.spans_file:
+            self.spans_file.close()
+            self.spans_file = None
+
+    # RPC instrumentation
+
+    def instrument_client(self, client):
+        """Time every request a Telethon client sends, named after its TL request (e.g. upload.GetFile)"""
+        # Every request, including file parts sent to other data centers, goes through _call
+        if not hasattr(client, "_call"):
+            return
+        original = client._call
+
+        async def timed_call(sender, request, *args, **kwargs):
+            method = getattr(request, "QUALNAME", type(request).__name__)
+            started = time.monotonic()
+            try:
+                result = await original(sender, request, *args, **kwargs)
+            except errors.FloodWaitError as e:
+                self.observe_rpc(method, time.monotonic() - started, error=e)
+                self.record_flood_wait(method, e.seconds)
+                raise
+            except Exception as e:
+                self.observe_rpc(method, time.monotonic() - started, error=e)
+                raise
+            self.observe_rpc(method, time.monotonic() - started)
+            return result
+
+        self.clients.append((client, client.__dict__.get("_call")))
+        client._call = timed_call
+
+    def release_clients(self):
+        """Remove the instrumentation again; the clients may outlive this run"""
+        for client, own_call in reversed(self.clients):
+            if own_call is None:
+                del client._call
+            else:
+                client._call = own_call
+        self.clients = []
+
+    def observe_rpc(self, method, seconds, error=None):
+        self.rpc_latency.setdefault(method, Histogram()).observe(seconds)
+        if error is not None:
+            self.rpc_errors[method] = self.rpc_errors.get(method, 0) + 1
+
+    def record_flood_wait(self, method, seconds):
+        self.flood_waits[method] = self.flood_waits.get(method, 0) + 1
+        self.flood_wait_seconds[method] = self.flood_wait_seconds.get(method, 0) + seconds
+
+    # Downloads and dialogs
+
+    def record_file(self, kind, name, size, seconds):
+        """Count a finished transfer and remember its individual throughput"""
+        self.files[kind] = self.files.get(kind, 0) + 1
+        self.bytes[kind] = self.bytes.get(kind, 0) + size
+        self.transfer_seconds[kind] = self.transfer_seconds.get(kind, 0.0) + seconds
+        self.recent_files.append({
+            "kind": kind,
+            "name": name,
+            "bytes": size,
+            "seconds": round(seconds, 3),
+            "mb_per_second": round(size / seconds / (1024 * 1024), 3) if seconds else None
+        })
+
+    def record_failure(self, kind):
+        self.failed[kind] = self.failed.get(kind, 0) + 1
+
+    def add_dialog_time(self, phase, dialog_name, seconds):
+        key = (phase, dialog_name)
+        self.dialog_seconds[key] = self.dialog_seconds.get(key, 0.0) + seconds
+
+    def register_gauge(self, name, read_value):
+        """Sample read_value() whenever a snapshot is taken"""
+        self.gauges[name] = read_value
+
+    @contextmanager
+    def span(self, name, **attributes):
+        """Time a block and append it to the spans file as one JSON line"""
+        started = time.time()
+        outcome = "ok"
+        try:
+            yield attributes
+        except BaseException as e:
+            outcome = type(e).__name__
+            raise
+        finally:
+            if self.spans_file:
+                record = dict(attributes, span=name, start=round(started, 3),
+                              seconds=round(time.time() - started, 4), outcome=outcome)
+                self.spans_file.write(json.dumps(record, ensure_ascii=False, default=str) + "\n")
+                self.spans_file.flush()
+
+    # Export
+
+    def snapshot(self):
+        """Return every metric as a JSON-serializable dict"""
+        elapsed = time.time() - self.started_at
+        total_bytes = sum(self.bytes.values())
+        return {
+            "timestamp": round(time.time(), 3),
+            "elapsed_seconds": round(elapsed, 3),
+            "rpc": {
+                method: dict(histogram.to_dict(),
+                             errors=self.rpc_errors.get(method, 0),
+                             flood_waits=self.flood_waits.get(method, 0),
+                             flood_wait_seconds=self.flood_wait_seconds.get(method, 0))
+                for method, histogram in sorted(self.rpc_latency.items())
+            },
+            "downloads": {
+                kind: {
+                    "files": self.files.get(kind, 0),
+                    "bytes": self.bytes.get(kind, 0),
+                    "transfer_seconds": round(self.transfer_seconds.get(kind, 0.0), 3),
+                    "failed": self.failed.get(kind, 0)
+                }
+                for kind in sorted(set(self.files) | set(self.failed))
+            },
+            "total_bytes": total_bytes,
+            "mb_per_second": round(total_bytes / elapsed / (1024 * 1024), 3) if elapsed else 0,
+            "active_downloads": self.active_downloads,
+            "gauges": {name: read_value() for name, read_value in self.gauges.items()},
+            "dialog_seconds": [
+                {"phase": phase, "dialog": dialog, "seconds": round(seconds, 3)}
+                for (phase, dialog), seconds in sorted(self.dialog_seconds.items(), key=lambda item: -item[1])
+            ],
+            "recent_files": list(self.recent_files)
+        }
+
+    def prometheus_text(self):
+        """Render the metrics in the Prometheus text exposition format"""
+        lines = []
+
+        def metric(name, kind, help_text, samples):
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {kind}")
+            for labels, value in samples:
+                label_text = ",".join(f'{key}="{escape_label(value)}"' for key, value in labels.items())
+                lines.append(f"{name}{{{label_text}}} {value}" if label_text else f"{name} {value}")
+
+        histogram_samples = []
+        for method, histogram in sorted(self.rpc_latency.items()):
+            for bound, count in zip(histogram.buckets, histogram.counts):
+                histogram_samples.append(({"method": method, "le": bound}, count))
+            histogram_samples.append(({"method": method, "le": "+Inf"}, histogram.count))
+        lines.append("# HELP scraper_rpc_duration_seconds Telegram request latency by request type")
+        lines.append("# TYPE scraper_rpc_duration_seconds histogram")
+        for labels, value in histogram_samples:
+            label_text = ",".join(f'{key}="{value}"' for key, value in labels.items())
+            lines.append(f"scraper_rpc_duration_seconds_bucket{{{label_text}}} {value}")
+        for method, histogram in sorted(self.rpc_latency.items()):
+            lines.append(f'scraper_rpc_duration_seconds_sum{{method="{method}"}} {histogram.sum:.6f}')
+            lines.append(f'scraper_rpc_duration_seconds_count{{method="{method}"}} {histogram.count}')
+
+        metric("scraper_rpc_errors_total", "counter", "Telegram requests that raised an error",
+               [({"method": method}, count) for method, count in sorted(self.rpc_errors.items())])
+        metric("scraper_flood_waits_total", "counter", "FloodWait errors by request type",
+               [({"method": method}, count) for method, count in sorted(self.flood_waits.items())])
+        metric("scraper_flood_wait_seconds_total", "counter", "Seconds of FloodWait imposed by request type",
+               [({"method": method}, seconds) for method, seconds in sorted(self.flood_wait_seconds.items())])
+        metric("scraper_files_downloaded_total", "counter", "Completed downloads by file type",
+               [({"kind": kind}, count) for kind, count in sorted(self.files.items())])
+        metric("scraper_bytes_downloaded_total", "counter", "Bytes of completed downloads by file type",
+               [({"kind": kind}, size) for kind, size in sorted(self.bytes.items())])
+        metric("scraper_transfer_seconds_total", "counter", "Time spent transferring completed files by file type",
+               [({"kind": kind}, f"{seconds:.3f}") for kind, seconds in sorted(self.transfer_seconds.items())])
+        metric("scraper_download_failures_total", "counter", "Failed downloads by file type",
+               [({"kind": kind}, count) for kind, count in sorted(self.failed.items())])
+        metric("scraper_active_downloads", "gauge", "Downloads currently transferring",
+               [({}, self.active_downloads)])
+        for name, read_value in sorted(self.gauges.items()):
+            metric(f"scraper_{name}", "gauge", name.replace("_", " ").capitalize(), [({}, read_value())])
+        metric("scraper_dialog_scan_seconds_total", "counter", "Time spent scanning each dialog",
+               [({"phase": phase, "dialog": dialog}, f"{seconds:.3f}")
+                for (phase, dialog), seconds in sorted(self.dialog_seconds.items())])
+        return "\n".join(lines) + "\n"
+
+    def write_snapshot(self, path):
+        # Written next to the target first so readers never see half a snapshot
+        tmp_path = path + ".tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(self.snapshot(), f, ensure_ascii=False, indent=2)
+        os.replace(tmp_path, path)
+
+    async def snapshot_loop(self, path, interval):
+        """Rewrite the JSON snapshot every interval seconds until cancelled"""
+        while True:
+            await asyncio.sleep(interval)
+            self.write_snapshot(path)
+
+    async def serve(self, port, host="127.0.0.1"):
+        """Serve the Prometheus text format over HTTP; returns the asyncio server"""
+        async def handle(reader, writer):
+            try:
+                request_line = await reader.readline()
+                # Drain the headers; the request body, if any, is ignored
+                while (await reader.readline()).strip():
+                    pass
+                path = request_line.split()[1].decode() if len(request_line.split()) > 1 else "/"
+                if path.startswith("/metrics.json"):
+                    body = json.dumps(self.snapshot(), ensure_ascii=False).encode()
+                    content_type = "application/json"
+                else:
+                    body = self.prometheus_text().encode()
+                    content_type = "text/plain; version=0.0.4"
+                writer.write(
+                    f"HTTP/1.1 200 OK\r\nContent-Type: {content_type}\r\n"
+                    f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode() + body
+                )
+                await writer.drain()
+            except Exception:
+                pass
+            finally:
+                writer.close()
+
+        return await asyncio.start_server(handle, host, port)
+
+
+def escape_label(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
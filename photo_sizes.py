@@ -0,0 +1,62 @@
+from telethon.tl import types
+
+# image_quality values besides a maximum width and height in pixels
+LARGEST = "largest"
+# The blurred preview of a few hundred bytes that comes with the message itself
+STRIPPED = "stripped"
+# Preview only: the image's metadata is recorded and no bytes are fetched
+METADATA_ONLY = "none"
+
+QUALITY_NAMES = (LARGEST, STRIPPED, METADATA_ONLY)
+
+# Sizes whose bytes are part of the message, so downloading them sends no request
+INLINE_SIZES = (types.PhotoStrippedSize, types.PhotoCachedSize)
+
+# Sizes with known dimensions; outlines (PhotoPathSize) and empty sizes are never picked
+SCALED_SIZES = (types.PhotoSize, types.PhotoSizeProgressive, types.PhotoCachedSize)
+
+
+def parse_image_quality(value):
+    """Return LARGEST, STRIPPED, METADATA_ONLY or a maximum dimension in pixels
+
+    Raises ValueError for anything else"""
+    if isinstance(value, str) and value.strip().lower() in QUALITY_NAMES:
+        return value.strip().lower()
+    try:
+        pixels = int(value)
+    except (TypeError, ValueError):
+        pixels = 0
+    if pixels <= 0:
+        raise ValueError(f"image_quality must be {', '.join(QUALITY_NAMES)} or a size in pixels, not {value!r}")
+    return pixels
+
+
+def photo_size_bytes(size):
+    """Return how many bytes downloading a photo size writes"""
+    if isinstance(size, INLINE_SIZES):
+        return len(size.bytes)
+    if isinstance(size, types.PhotoSizeProgressive):
+        return max(size.sizes)
+    return getattr(size, "size", 0)
+
+
+def select_photo_size(photo, quality):
+    """Return the size of a photo that quality asks for, or None to let Telethon take the largest
+
+    A maximum dimension picks the largest size that fits; photos with none that small get their smallest"""
+    if quality in (LARGEST, METADATA_ONLY):
+        return None
+    sizes = getattr(photo, "sizes", None) or []
+    if quality == STRIPPED:
+        stripped = [size for size in sizes if isinstance(size, types.PhotoStrippedSize)]
+        if stripped:
+            return stripped[0]
+        quality = 0
+
+    scaled = [size for size in sizes if isinstance(size, SCALED_SIZES)]
+    if not scaled:
+        return None
+    fitting = [size for size in scaled if max(size.w, size.h) <= quality]
+    if fitting:
+        return max(fitting, key=lambda size: size.w * size.h)
+    return min(scaled, key=lambda size: size.w * size.h)
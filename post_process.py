@@ -0,0 +1,235 @@
+import asyncio
+import bz2
+import functools
+import gzip
+import hashlib
+import lzma
+import os
+import tarfile
+import zipfile
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    from PIL import Image
+except ImportError:  # thumbnails are optional
+    Image = None
+
+try:
+    import rarfile
+except ImportError:
+    rarfile = None
+
+try:
+    import py7zr
+except ImportError:
+    py7zr = None
+
+# Read size for hashing and for stream-compressed archives
+READ_BLOCK = 1024 * 1024
+
+
+def file_sha256(path):
+    """Hash a completed file in 1 MB blocks"""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(READ_BLOCK), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+class ArchiveError(Exception):
+    """An archive failed its integrity check"""
+
+
+class ArchiveUnverifiable(Exception):
+    """An archive cannot be checked here: it is encrypted, uses an unsupported method or needs a missing tool"""
+
+
+# Archive checkers: each reads the whole archive and raises ArchiveError if it is corrupt or truncated,
+# or ArchiveUnverifiable if it cannot tell
+
+def check_zip(path):
+    try:
+        with zipfile.ZipFile(path) as archive:
+            if any(info.flag_bits & 0x1 for info in archive.infolist()):
+                raise ArchiveUnverifiable("encrypted, password required")
+            bad_member = archive.testzip()
+    except (zipfile.BadZipFile, zlib.error, EOFError) as e:
+        raise ArchiveError(str(e))
+    except NotImplementedError as e:
+        raise ArchiveUnverifiable(str(e))
+    if bad_member is not None:
+        raise ArchiveError(f"CRC mismatch in {bad_member}")
+
+
+def check_tar(path):
+    try:
+        with tarfile.open(path, 'r:*') as archive:
+            for member in archive:
+                if member.isfile():
+                    with archive.extractfile(member) as f:
+                        while f.read(READ_BLOCK):
+                            pass
+    except (tarfile.TarError, EOFError, OSError) as e:
+        raise ArchiveError(str(e))
+
+
+def check_stream(open_stream, path):
+    # gzip and bz2 verify their CRC and raise on a truncated stream once read to the end
+    try:
+        with open_stream(path, 'rb') as f:
+            while f.read(READ_BLOCK):
+                pass
+    except (EOFError, OSError, ValueError) as e:
+        raise ArchiveError(str(e))
+
+
+def check_compressed_tar(open_stream, path):
+    # tarfile stops at the end-of-archive marker, so a cut-off compressed trailer needs its own pass
+    check_stream(open_stream, path)
+    check_tar(path)
+
+
+def check_rar(path):
+    # Needs the unrar tool that rarfile drives
+    try:
+        with rarfile.RarFile(path) as archive:
+            if archive.needs_password():
+                raise ArchiveUnverifiable("encrypted, password required")
+            archive.testrar()
+    except (rarfile.BadRarFile, rarfile.NotRarFile, rarfile.RarCRCError) as e:
+        raise ArchiveError(str(e) or type(e).__name__)
+    except rarfile.RarCannotExec as e:
+        raise ArchiveUnverifiable(f"no unrar tool: {e}")
+    except rarfile.Error as e:
+        # Wrong passwords, later volumes of a set and other states the tool cannot test
+        raise ArchiveUnverifiable(str(e) or type(e).__name__)
+
+
+def check_7z(path):
+    try:
+        with py7zr.SevenZipFile(path, 'r') as archive:
+            if archive.needs_password():
+                raise ArchiveUnverifiable("encrypted, password required")
+            bad_member = archive.testzip()
+    except (py7zr.exceptions.Bad7zFile, py7zr.exceptions.CrcError, py7zr.exceptions.DecompressionError,
+            lzma.LZMAError, zlib.error, EOFError) as e:
+        raise ArchiveError(str(e) or type(e).__name__)
+    except (py7zr.exceptions.PasswordRequired, py7zr.exceptions.UnsupportedCompressionMethodError) as e:
+        raise ArchiveUnverifiable(str(e) or type(e).__name__)
+    if bad_member is not None:
+        raise ArchiveError(f"CRC mismatch in {bad_member}")
+
+
+# File name suffix -> checker; the longest matching suffix wins, so .tar.gz is checked as a tar
+ARCHIVE_CHECKERS = {
+    ".zip": check_zip,
+    ".tar": check_tar,
+    ".tgz": functools.partial(check_compressed_tar, gzip.open),
+    ".tar.gz": functools.partial(check_compressed_tar, gzip.open),
+    ".tar.bz2": functools.partial(check_compressed_tar, bz2.open),
+    ".gz": functools.partial(check_stream, gzip.open),
+    ".bz2": functools.partial(check_stream, bz2.open)
+}
+if rarfile is not None:
+    ARCHIVE_CHECKERS[".rar"] = check_rar
+if py7zr is not None:
+    ARCHIVE_CHECKERS[".7z"] = check_7z
+
+
+def register_checker(suffix, checker):
+    """Check files ending in suffix with checker(path)
+
+    The checker raises ArchiveError on a corrupt file and ArchiveUnverifiable when it cannot check one"""
+    ARCHIVE_CHECKERS[suffix.lower()] = checker
+
+
+def checker_for(path):
+    """Return the checker for a file name, or None for formats that cannot be checked"""
+    name = path.lower()
+    matches = [suffix for suffix in ARCHIVE_CHECKERS if name.endswith(suffix)]
+    return ARCHIVE_CHECKERS[max(matches, key=len)] if matches else None
+
+
+def thumbnail_path_for(thumbnails_path, image_path):
+    return os.path.join(thumbnails_path, os.path.splitext(os.path.basename(image_path))[0] + ".jpg")
+
+
+def make_thumbnail(image_path, thumbnail_path, size):
+    with Image.open(image_path) as image:
+        image.thumbnail((size, size))
+        image.convert("RGB").save(thumbnail_path, "JPEG", quality=85)
+
+
+class PostProcessResult:
+    """Outcome of the checks on one finished download"""
+    def __init__(self, path):
+        self.path = path
+        self.sha256 = None
+        self.error = None
+        # Why an archive could not be checked; it is kept as it is
+        self.unverified = None
+        self.thumbnail_path = None
+        self.thumbnail_error = None
+
+
+def check_file(path, kind, verify_archives=True, thumbnails_path="", thumbnail_size=256):
+    """Hash a finished file, test it if it is an archive and thumbnail it if it is an image"""
+    result = PostProcessResult(path)
+    result.sha256 = file_sha256(path)
+
+    checker = checker_for(path) if verify_archives and kind == "archive" else None
+    if checker is not None:
+        try:
+            checker(path)
+        except ArchiveError as e:
+            result.error = str(e) or type(e).__name__
+        except Exception as e:
+            # Only a failed check means corrupt; anything else the library raises leaves the file unchecked
+            result.unverified = str(e) or type(e).__name__
+
+    if thumbnails_path and kind == "image" and Image is not None:
+        try:
+            thumbnail_path = thumbnail_path_for(thumbnails_path, path)
+            make_thumbnail(path, thumbnail_path, thumbnail_size)
+            result.thumbnail_path = thumbnail_path
+        except Exception as e:
+            result.thumbnail_error = str(e)
+    return result
+
+
+class PostProcessor:
+    """Checks finished downloads in a thread pool while further transfers continue"""
+    def __init__(self, workers=2, verify_archives=True, thumbnails_path="", thumbnail_size=256):
+        # hashlib, zlib and bz2 release the GIL on large buffers, so threads run the checks in parallel
+        self.executor = ThreadPoolExecutor(max_workers=max(1, workers), thread_name_prefix="post-process")
+        self.verify_archives = verify_archives
+        self.thumbnails_path = thumbnails_path
+        self.thumbnail_size = thumbnail_size
+        self.pending = set()
+        if thumbnails_path:
+            os.makedirs(thumbnails_path, exist_ok=True)
+
+    def submit(self, file_path, kind, on_result):
+        """Check file_path in the pool, then await on_result(result) on the event loop"""
+        task = asyncio.ensure_future(self._process(file_path, kind, on_result))
+        self.pending.add(task)
+        task.add_done_callback(self.pending.discard)
+
+    async def _process(self, file_path, kind, on_result):
+        loop = asyncio.get_running_loop()
+        result = await loop.run_in_executor(self.executor, functools.partial(
+            check_file, file_path, kind, self.verify_archives, self.thumbnails_path, self.thumbnail_size
+        ))
+        await on_result(result)
+
+    async def join(self):
+        """Wait until every submitted file has been checked and handled"""
+        while self.pending:
+            await asyncio.gather(*list(self.pending), return_exceptions=True)
+
+    def close(self):
+        for task in self.pending:
+            task.cancel()
+        self.executor.shutdown(wait=False)
@@ -0,0 +1,121 @@
+import asyncio
+import time
+
+from telethon import errors
+
+# Request classes with separate budgets
+SEARCH_REQUESTS = "search"
+FILE_REQUESTS = "file"
+
+
+class SessionThrottled(Exception):
+    """A request class is paused for longer than the caller is willing to wait"""
+    def __init__(self, seconds):
+        super().__init__(f"paused for {seconds:.0f} more seconds")
+        self.seconds = seconds
+
+
+class AdaptiveTokenBucket:
+    """Token bucket that halves its rate on FloodWait and creeps back up while quiet"""
+    def __init__(self, name, max_rate, burst=None, min_rate=None, recovery_period=30.0):
+        self.name = name
+        self.max_rate = float(max_rate)
+        self.min_rate = float(min_rate) if min_rate else self.max_rate / 20
+        self.rate = self.max_rate
+        self.burst = float(burst or max(1.0, self.max_rate))
+        self.recovery_period = recovery_period
+
+        self.tokens = self.burst
+        now = time.monotonic()
+        self.updated_at = now
+        self.last_flood_at = None
+        self.last_relax_at = now
+        self.paused_until = 0.0
+
+        # FloodWait bookkeeping for status reports
+        self.flood_waits = 0
+        self.flood_wait_seconds = 0
+
+    async def acquire(self, max_pause=None):
+        """Wait until this request class may send one more request
+
+        Raises SessionThrottled instead of sitting out a FloodWait pause of max_pause seconds or more"""
+        while True:
+            now = time.monotonic()
+            if now < self.paused_until:
+                if max_pause is not None and self.paused_until - now >= max_pause:
+                    raise SessionThrottled(self.paused_until - now)
+                await asyncio.sleep(self.paused_until - now)
+                continue
+
+            self._relax(now)
+            self.tokens = min(self.burst, self.tokens + (now - self.updated_at) * self.rate)
+            self.updated_at = now
+
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return
+            await asyncio.sleep((1 - self.tokens) / self.rate)
+
+    def paused_for(self):
+        """Return how many seconds this class is still paused by a FloodWait"""
+        return max(0.0, self.paused_until - time.monotonic())
+
+    def on_flood_wait(self, seconds):
+        """Pause this class for the server-imposed wait and tighten its rate once per episode"""
+        now = time.monotonic()
+        # Requests already in flight when the first FloodWait came back only extend the pause
+        if now >= self.paused_until:
+            self.rate = max(self.min_rate, self.rate / 2)
+        self.paused_until = max(self.paused_until, now + seconds)
+        self.tokens = 0
+        self.updated_at = self.paused_until
+        self.last_flood_at = now
+        self.flood_waits += 1
+        self.flood_wait_seconds += seconds
+
+    def _relax(self, now):
+        # Additive increase: one step per quiet recovery period, back up to the configured rate
+        if self.rate >= self.max_rate:
+            return
+        quiet_since = max(self.last_flood_at or 0, self.last_relax_at)
+        if now - quiet_since >= self.recovery_period:
+            self.rate = min(self.max_rate, self.rate + self.max_rate / 10)
+            self.last_relax_at = now
+
+
+class RateLimiter:
+    """Shared FloodWait-aware budgets for search/history requests and file part requests"""
+    def __init__(self, search_rate=2.0, file_rate=50.0, log_callback=None):
+        self.buckets = {
+            SEARCH_REQUESTS: AdaptiveTokenBucket(SEARCH_REQUESTS, search_rate, burst=max(1.0, search_rate * 2)),
+            FILE_REQUESTS: AdaptiveTokenBucket(FILE_REQUESTS, file_rate)
+        }
+        self.log_callback = log_callback
+
+    async def acquire(self, request_class, max_pause=None):
+        await self.buckets[request_class].acquire(max_pause)
+
+    def paused_for(self, request_class):
+        return self.buckets[request_class].paused_for()
+
+    def on_flood_wait(self, request_class, seconds):
+        """Pause only the request class that hit the limit"""
+        bucket = self.buckets[request_class]
+        bucket.on_flood_wait(seconds)
+        if self.log_callback:
+            self.log_callback(
+                f"⏳ Rate limited, pausing {request_class} requests for {seconds} seconds "
+                f"(now {bucket.rate:.2f} req/s)"
+            )
+
+    async def call(self, request_class, request, max_pause=None):
+        """Await request() within the budget, retrying after each FloodWait
+
+        With max_pause set, a pause of at least that many seconds raises SessionThrottled instead"""
+        while True:
+            await self.acquire(request_class, max_pause)
+            try:
+                return await request()
+            except errors.FloodWaitError as e:
+                self.on_flood_wait(request_class, e.seconds)
@@ -0,0 +1,124 @@
+import asyncio
+import heapq
+import itertools
+import math
+from collections import OrderedDict
+
+# Scores are counted in steps, lower runs first. Archives start this many steps behind images
+CLASS_STEPS = {"image": 0, "archive": 8}
+
+# Each doubling of the size above this adds a step; smaller files are all equally small
+SIZE_FLOOR = 256 * 1024
+
+# Assumed size of a job whose file has not been looked up yet
+UNKNOWN_SIZE = 64 * 1024 * 1024
+
+# Dialogs whose next job is within this many steps of the best one take turns
+FAIRNESS_STEPS = 1.0
+
+
+def size_steps(size):
+    return math.log2(max(size or UNKNOWN_SIZE, SIZE_FLOOR) / SIZE_FLOOR)
+
+
+class JobScheduler:
+    """Download queue that hands out small files and images first, ages waiting jobs and takes dialogs in turn
+
+    It has the interface of asyncio.Queue that the engine uses: put, get, task_done, join, qsize and empty.
+    Jobs of a held kind wait outside the queue until release(kind), so no worker blocks on them."""
+    def __init__(self, maxsize=0, aging_seconds=30.0):
+        self.maxsize = maxsize
+        # A job that has waited this long moves up by one step
+        self.aging_seconds = max(0.001, aging_seconds)
+        # Dialog key -> heap of (score, sequence, job); the order of the keys is the round-robin order
+        self.dialogs = OrderedDict()
+        self.size = 0
+        self.unfinished = 0
+        self.sequence = itertools.count()
+        self.held_kinds = set()
+        self.held = []
+        self.changed = asyncio.Condition()
+        self.finished = asyncio.Event()
+        self.finished.set()
+
+    def score(self, job):
+        """Return the job's sort key; waiting lowers every score at the same rate, so the key is fixed"""
+        if job.priority is not None:
+            steps = job.priority
+        else:
+            steps = CLASS_STEPS.get(job.kind, 0) + size_steps(job.size)
+        return steps + job.queued_at / self.aging_seconds
+
+    async def put(self, job):
+        if job.kind in self.held_kinds:
+            # Held jobs count as unfinished for join() but not towards maxsize, so discovery goes on
+            self.held.append(job)
+            self.unfinished += 1
+            self.finished.clear()
+            return
+        async with self.changed:
+            await self.changed.wait_for(lambda: not self.maxsize or self.size < self.maxsize)
+            heap = self.dialogs.setdefault(job.dialog_id, [])
+            heapq.heappush(heap, (self.score(job), next(self.sequence), job))
+            self.size += 1
+            self.unfinished += 1
+            self.finished.clear()
+            self.changed.notify_all()
+
+    async def get(self):
+        async with self.changed:
+            await self.changed.wait_for(lambda: self.size > 0)
+            best = min(heap[0][0] for heap in self.dialogs.values())
+            # The first dialog in turn whose next job is about as urgent as the best one
+            for dialog_key, heap in self.dialogs.items():
+                if heap[0][0] <= best + FAIRNESS_STEPS:
+                    break
+            _, _, job = heapq.heappop(heap)
+            if heap:
+                self.dialogs.move_to_end(dialog_key)
+            else:
+                del self.dialogs[dialog_key]
+            self.size -= 1
+            self.changed.notify_all()
+            return job
+
+    def hold(self, kind):
+        """Keep jobs of a kind from the workers until release(kind)"""
+        self.held_kinds.add(kind)
+
+    async def release(self, kind):
+        """Hand the held jobs of a kind to the workers; later jobs of the kind are queued as usual"""
+        self.held_kinds.discard(kind)
+        released = [job for job in self.held if job.kind == kind]
+        self.held = [job for job in self.held if job.kind != kind]
+        async with self.changed:
+            # These were accepted while held, so they go in even past maxsize
+            for job in released:
+                heap = self.dialogs.setdefault(job.dialog_id, [])
+                heapq.heappush(heap, (self.score(job), next(self.sequence), job))
+            self.size += len(released)
+            self.changed.notify_all()
+
+    def task_done(self):
+        self.unfinished -= 1
+        if self.unfinished <= 0:
+            self.finished.set()
+
+    async def join(self):
+        await self.finished.wait()
+
+    def qsize(self):
+        return self.size
+
+    def empty(self):
+        return self.size == 0
+
+    def pending(self):
+        """Return the jobs waiting to be handed out, held ones included"""
+        return [job for heap in self.dialogs.values() for _, _, job in heap] + self.held
+
+    def reprioritize(self):
+        """Score the waiting jobs again after their sizes or priorities changed"""
+        for dialog_key, heap in self.dialogs.items():
+            self.dialogs[dialog_key] = [(self.score(job), sequence, job) for _, sequence, job in heap]
+            heapq.heapify(self.dialogs[dialog_key])
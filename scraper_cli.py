@@ -0,0 +1,146 @@
+"""Headless entry point: python -m scraper_cli run --query CODE [--query CODE ...] --config config.json
+
+Offline lookup in the local mirror: python -m scraper_cli search TEXT --config config.json"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import sys
+
+from crawl_state import CrawlState, state_path_for
+from message_mirror import DOCUMENT, PHOTO, MessageMirror
+from scraper_engine import DEFAULT_CONFIG, ScraperEngine, load_config
+
+# Command line flags that override the config file, keyed by config.json setting
+CONFIG_FLAGS = {
+    "queries_file": ("--queries-file", str, "file with one search query per line"),
+    "session_path": ("--session", str, "session file path without the .session extension"),
+    "images_path": ("--images-path", str, "folder for downloaded images"),
+    "archives_path": ("--archives-path", str, "folder for downloaded archives"),
+    "max_concurrent_downloads": ("--max-concurrent-downloads", int, "number of download workers"),
+    "chunk_size": ("--chunk-size", int, "byte range size for archive downloads, in bytes"),
+    "max_parallel_parts": ("--max-parallel-parts", int, "byte ranges in flight across all files"),
+    "dialog_parallelism": ("--dialog-parallelism", int, "dialogs searched at the same time"),
+    "image_quality": ("--image-quality", str, "largest, a maximum width/height in pixels, stripped, or none")
+}
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(prog="scraper_cli", description="Telegram media downloader without a GUI")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    run_parser = subparsers.add_parser("run", help="search and download once, then exit")
+    run_parser.add_argument("--config", help="config.json to read settings from")
+    run_parser.add_argument(
+        "--query", dest="queries", action="append",
+        help="search keyword or code; repeat to run several queries over one connection"
+    )
+    for key, (flag, flag_type, help_text) in CONFIG_FLAGS.items():
+        run_parser.add_argument(flag, dest=key, type=flag_type, help=help_text)
+    run_parser.add_argument(
+        "--watch", action="store_true", default=None,
+        help="after the search, keep running and download new posts as they arrive"
+    )
+    run_parser.add_argument(
+        "--mirror-photos", dest="mirror_photos", action="store_true", default=None,
+        help="scan every photo once into the local mirror and answer the queries from it"
+    )
+
+    search_parser = subparsers.add_parser("search", help="look up messages in the local mirror without connecting")
+    search_parser.add_argument("text", help="text to find in captions and file names")
+    search_parser.add_argument("--config", help="config.json to read the session path from")
+    search_parser.add_argument("--session", dest="session_path", help="session file path without the .session extension")
+    search_parser.add_argument("--kind", choices=[PHOTO, DOCUMENT], help="only photos or only documents")
+    search_parser.add_argument("--dialog", dest="dialog_id", type=int, help="only this dialog id")
+    search_parser.add_argument("--limit", type=int, default=50, help="most matches to list, 0 for all")
+    search_parser.add_argument("--json", action="store_true", help="print the matches as JSON lines")
+
+    return parser
+
+
+def config_from_args(args):
+    """Merge the config file with the flags given on the command line"""
+    config = load_config(args.config) if args.config else dict(DEFAULT_CONFIG)
+    for key in list(CONFIG_FLAGS) + ["watch", "mirror_photos"]:
+        value = getattr(args, key)
+        if value is not None:
+            config[key] = value
+    
+    # Queries given on the command line replace the ones from the config file
+    if args.queries:
+        config["search_query"] = ""
+        config["search_queries"] = args.queries
+    return config
+
+
+def run(args):
+    engine = ScraperEngine(config_from_args(args))
+    try:
+        asyncio.run(engine.run())
+    except KeyboardInterrupt:
+        logging.warning("🛑 Interrupted")
+        return 130
+    except ValueError as e:
+        logging.error(f"❌ {e}")
+        return 2
+    except Exception as e:
+        # Errors before the engine's own handling, such as an unreadable queries file, are not logged yet
+        logging.error(f"❌ {e}")
+        return 1
+
+    logging.info(
+        f"Images: {engine.downloaded_images} | Archives: {engine.downloaded_archives} | Failed: {engine.failed_downloads}"
+    )
+    return 0
+
+
+def search(args):
+    """List the mirrored messages that contain a text, with what a run would still do for their codes"""
+    config = load_config(args.config) if args.config else dict(DEFAULT_CONFIG)
+    if args.session_path:
+        config["session_path"] = args.session_path
+    state_path = state_path_for(config["session_path"])
+    if not config["session_path"] or not os.path.exists(state_path):
+        logging.error(f"❌ No state database at {state_path}; run a download first")
+        return 2
+
+    mirror = MessageMirror(state_path)
+    crawl_state = CrawlState(state_path)
+    try:
+        rows = mirror.search(args.text, dialog_id=args.dialog_id, kind=args.kind, limit=args.limit)
+        statuses = crawl_state.code_statuses({row["code"] for row in rows if row["code"]})
+    finally:
+        crawl_state.close()
+        mirror.close()
+
+    for row in rows:
+        # Codes no run has seen yet would be queued by the next run of a matching query
+        status = statuses.get(row["code"], "new") if row["code"] else ""
+        if args.json:
+            print(json.dumps(dict(dict(row), status=status), ensure_ascii=False))
+        else:
+            size = f"{row['size'] / (1024 * 1024):.1f} MB" if row["size"] else "?"
+            print(f"{row['dialog_id']}\t{row['message_id']}\t{row['kind']}\t{size}\t{row['code'] or '-'}\t"
+                  f"{status or '-'}\t{row['file_name'] or row['caption'][:80]}")
+
+    counts = [statuses.get(row["code"], "new") for row in rows if row["code"]]
+    logging.info(
+        f"{len(rows)} matches | New codes: {counts.count('new')} | Unfinished: {counts.count('unfinished')} | "
+        f"Done: {counts.count('done')}"
+    )
+    return 0
+
+
+def main(argv=None):
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    args = build_parser().parse_args(argv)
+
+    if args.command == "run":
+        return run(args)
+    if args.command == "search":
+        return search(args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,1476 @@
+import asyncio
+import functools
+import json
+import logging
+import os
+import shutil
+import time
+
+from telethon import TelegramClient, errors, events
+from telethon.tl.types import InputMessagesFilterDocument, InputMessagesFilterPhotos, InputPeerChannel
+
+from caption_parser import CaptionParser, archive_index_keys, archive_key
+from chunked_download import ChunkedDownloader, finalize_part, part_path_for
+from crawl_state import ARCHIVE_SCAN_QUERY, IMAGE_PREVIEW_ONLY, PHOTO_SCAN_QUERY, CrawlState, state_path_for
+from dialog_cache import CachedDialog, DialogCache, dialog_cache_path_for, filter_dialogs
+from disk_space import DiskSpace, is_disk_full
+from message_mirror import PHOTO, MessageMirror
+from metrics import Metrics
+from photo_sizes import INLINE_SIZES, LARGEST, METADATA_ONLY, parse_image_quality, photo_size_bytes, select_photo_size
+from post_process import Image, PostProcessor
+from rate_limiter import FILE_REQUESTS, SEARCH_REQUESTS, RateLimiter, SessionThrottled
+from scheduler import JobScheduler
+from session_pool import Session, SessionPool
+
+logger = logging.getLogger(__name__)
+
+# Dialogs and messages come back from Telegram in pages of this size, one request per page
+HISTORY_PAGE_SIZE = 100
+
+# Seconds between the progress samples sent to the front end
+PROGRESS_INTERVAL = 0.5
+
+# Seconds between the connection checks of watch mode
+WATCH_CHECK_INTERVAL = 1.0
+
+# Seconds before watch mode tries again to catch up on dialogs whose catch-up scans failed
+CATCH_UP_RETRY_INTERVAL = 60.0
+
+# Settings understood by the engine, with the same keys as config.json
+DEFAULT_CONFIG = {
+    "api_id": "",
+    "api_hash": "",
+    "phone_number": "",
+    "session_path": "",
+    "extra_session_paths": [],
+    "session_failover_after": 10,
+    "search_query": "",
+    "search_queries": [],
+    "queries_file": "",
+    "watch": False,
+    "mirror_photos": False,
+    "images_path": "",
+    "archives_path": "",
+    "image_quality": LARGEST,
+    "max_concurrent_downloads": 3,
+    "scheduler_window": 500,
+    "priority_aging_seconds": 30,
+    "query_priorities": {},
+    "chunk_size": 1024 * 1024,
+    "max_parallel_parts": 8,
+    "min_free_space_mb": 512,
+    "search_requests_per_second": 2.0,
+    "file_requests_per_second": 50.0,
+    "dialog_parallelism": 3,
+    "dialog_filters": {},
+    "code_rule": {},
+    "dialog_cache_ttl": 3600,
+    "metrics_port": 0,
+    "metrics_snapshot_path": "",
+    "metrics_snapshot_interval": 10,
+    "metrics_spans_path": "",
+    "verify_archives": True,
+    "verify_retries": 2,
+    "post_process_workers": 2,
+    "thumbnails_path": "",
+    "thumbnail_size": 256
+}
+
+
+def load_config(path):
+    """Read a config.json file and fill in defaults for missing settings"""
+    with open(path, 'r') as f:
+        config = json.load(f)
+    return dict(DEFAULT_CONFIG, **config)
+
+
+def resolve_queries(config):
+    """Return the queries of a job: search_query, search_queries and the lines of queries_file"""
+    queries = []
+    if config.get("search_query"):
+        queries.append(config["search_query"])
+    queries.extend(config.get("search_queries") or [])
+    
+    if config.get("queries_file"):
+        with open(config["queries_file"], 'r', encoding='utf-8') as f:
+            for line in f:
+                line = line.strip()
+                # Blank lines and # comments are allowed in the file
+                if line and not line.startswith("#"):
+                    queries.append(line)
+    
+    # Keep the first occurrence of each query, in order
+    return list(dict.fromkeys(query.strip() for query in queries if query.strip()))
+
+
+def validate_config(config):
+    """Raise ValueError if the settings cannot be used for a download run"""
+    if not config.get("api_id") or not config.get("api_hash"):
+        raise ValueError("API ID and API Hash are required")
+    
+    if not config.get("session_path"):
+        raise ValueError("Session file path is required")
+    
+    if not resolve_queries(config):
+        raise ValueError("Search query is required")
+    
+    if not config.get("images_path") or not config.get("archives_path"):
+        raise ValueError("Both images and archives paths are required")
+    
+    # Raises ValueError for an unknown mode or a pattern that does not compile
+    CaptionParser(config.get("code_rule"))
+    parse_image_quality(config.get("image_quality", LARGEST))
+
+
+def create_client(config):
+    """Create the Telegram client for the configured session"""
+    return TelegramClient(
+        config["session_path"],
+        int(config["api_id"]),
+        config["api_hash"],
+        connection_retries=5,
+        retry_delay=1,
+        # FloodWaits are raised to the rate limiter instead of sleeping inside Telethon
+        flood_sleep_threshold=0
+    )
+
+
+def caption_for(message):
+    """Return the text a photo's code and name are taken from"""
+    if hasattr(message, 'file') and message.file and hasattr(message.file, 'name') and message.file.name:
+        return message.file.name
+    if message.text:
+        return message.text
+    return f"{message.id}.jpg"
+
+
+def mirrored_caption(row):
+    """Return the text caption_for would give for a message stored in the mirror"""
+    return row["file_name"] or row["caption"] or f"{row['message_id']}.jpg"
+
+
+def matches_query(search_name, message):
+    """Match a post against a query locally, like the server-side search: case-insensitive, anywhere in the caption"""
+    return search_name.lower() in (message.text or "").lower()
+
+
+def mirror_entry(message, code=None, clean_name=None):
+    """Return the metadata of a photo or document message in the form MessageMirror.add stores"""
+    media_type, media_id, access_hash, size = media_identity(message)
+    file_name = (message.file.name if message.file else None) or ""
+    date = message.date.timestamp() if message.date else None
+    return (message.id, media_type, message.text or "", file_name, size, media_id, access_hash, code, clean_name, date)
+
+
+def media_identity(message):
+    """Return (media type, media id, access hash, size) of a message's photo or document"""
+    media = message.document or message.photo
+    if media is None:
+        return None
+    media_type = "document" if message.document else "photo"
+    size = message.file.size if message.file else None
+    return media_type, media.id, getattr(media, 'access_hash', None), size
+
+
+def link_or_copy(source, target):
+    """Hard-link source to target, copying where the filesystem cannot link"""
+    try:
+        os.link(source, target)
+    except OSError:
+        shutil.copyfile(source, target)
+
+
+def unique_path(path, reserved=()):
+    """Return path, or 'name (2).ext', 'name (3).ext'... if it is taken"""
+    stem, ext = os.path.splitext(path)
+    candidate = path
+    counter = 2
+    while candidate in reserved or os.path.exists(candidate) or os.path.exists(part_path_for(candidate)):
+        candidate = f"{stem} ({counter}){ext}"
+        counter += 1
+    return candidate
+
+
+# Per-query report name for codes requeued from earlier runs
+RESUMED_QUERY = "(resumed from earlier runs)"
+
+# Per-query report name for archives posted after their image, while watching
+WATCH_QUERY = "(archives posted while watching)"
+
+
+def new_query_stats():
+    return {"found": 0, "images": 0, "archives": 0, "missing_archives": 0, "failed": 0}
+
+
+class ScraperEngine:
+    """Search and download engine that runs without any GUI"""
+    def __init__(self, config, log_callback=None, stats_callback=None, status_callback=None, client=None,
+                 progress_callback=None):
+        self.config = dict(DEFAULT_CONFIG, **config)
+        
+        # Optional hooks for a front end; without them everything goes to the logger
+        self.log_callback = log_callback
+        self.stats_callback = stats_callback
+        self.status_callback = status_callback
+        self.progress_callback = progress_callback
+        
+        # A client set before run() belongs to the caller and stays connected afterwards
+        self.client = client
+        self.owns_client = False
+        self.pool = None
+        self.crawl_state = None
+        self.mirror = None
+        self.chunked_downloader = None
+        self.rate_limiter = None
+        self.post_processor = None
+        self.disk_space = None
+        self.queue = None
+        self.archive_index = None
+        self.dialogs = []
+        self.query_stats = {}
+        self.caption_parser = CaptionParser()
+        self.image_quality = LARGEST
+        self.metrics = Metrics()
+        self.is_running = False
+        # The task and loop of the current run, so stop() can cancel it from another thread
+        self.run_task = None
+        self.loop = None
+        self.stop_requested = False
+        self.paused = False
+        # Set when a write hit a full volume; the run then winds down instead of failing every file
+        self.disk_full = False
+        # Watch mode: ids of the dialogs that may have missed posts; their scan watermarks stay where they are
+        self.watch_gaps = set()
+        # Codes with an archive job queued or running, so a newly posted archive is not queued twice
+        self.queued_archive_codes = set()
+        
+        # Downloads in progress: target path -> media, and media -> event set when it is done
+        self.reserved_paths = {}
+        self.inflight_media = {}
+        
+        # Byte progress of the running transfers, and the job counts behind the overall progress
+        self.transfers = {}
+        self.bytes_completed = 0
+        self.sampled_bytes = 0
+        self.bytes_per_second = 0.0
+        self.jobs_queued = 0
+        self.jobs_done = 0
+        # Unknown until discovery has queued its last job
+        self.jobs_total = None
+        
+        # Statistics
+        self.downloaded_images = 0
+        self.downloaded_archives = 0
+        self.failed_downloads = 0
+    
+    def log(self, message):
+        """Send a message to the front end, or the logger when there is none"""
+        if self.log_callback:
+            self.log_callback(message)
+        else:
+            logger.info(message)
+    
+    def update_stats(self):
+        """Report the download counters to the front end"""
+        if self.stats_callback:
+            self.stats_callback(self.downloaded_images, self.downloaded_archives, self.failed_downloads)
+    
+    def set_status(self, status):
+        """Report a one-line status to the front end"""
+        if self.status_callback:
+            self.status_callback(status)
+        else:
+            logger.info(status)
+    
+    def stop(self):
+        """Stop a running download now; transfers in flight are cancelled and resume on the next run
+
+        Safe to call from another thread, such as the GUI's"""
+        self.is_running = False
+        self.stop_requested = True
+        if self.loop is not None and not self.loop.is_closed():
+            self.loop.call_soon_threadsafe(self.cancel_run)
+    
+    def pause(self):
+        """Stop like stop(), but report the run as paused so the front end can offer to resume it"""
+        self.paused = True
+        self.stop()
+    
+    def cancel_run(self):
+        # Runs on the engine's loop; a run that already finished has nothing to cancel
+        if self.run_task is not None:
+            self.run_task.cancel()
+    
+    async def run(self):
+        """Connect, then search and download until done or stopped"""
+        validate_config(self.config)
+        self.caption_parser = CaptionParser(self.config["code_rule"])
+        self.image_quality = parse_image_quality(self.config["image_quality"])
+        os.makedirs(self.config["images_path"], exist_ok=True)
+        os.makedirs(self.config["archives_path"], exist_ok=True)
+        
+        # Reset statistics
+        self.downloaded_images = 0
+        self.downloaded_archives = 0
+        self.failed_downloads = 0
+        self.update_stats()
+        self.bytes_completed = 0
+        self.sampled_bytes = 0
+        self.bytes_per_second = 0.0
+        self.jobs_queued = 0
+        self.jobs_done = 0
+        self.jobs_total = None
+        
+        self.is_running = True
+        # A stop or pause requested before the run started, such as while the front end was connecting,
+        # still applies; a pause left over from an earlier run does not
+        if not self.stop_requested:
+            self.paused = False
+        self.loop = asyncio.get_running_loop()
+        self.run_task = asyncio.current_task()
+        self.disk_full = False
+        self.watch_gaps = set()
+        self.queued_archive_codes = set()
+        self.archive_index = None
+        self.pool = None
+        self.metrics = Metrics(spans_path=self.config["metrics_spans_path"] or None)
+        metrics_tasks = []
+        metrics_server = None
+        if self.client is None:
+            self.client = create_client(self.config)
+            self.owns_client = True
+        
+        try:
+            if self.stop_requested:
+                # stop() found no loop to cancel yet
+                raise asyncio.CancelledError()
+            if not self.client.is_connected():
+                await self.client.connect()
+            if not await self.client.is_user_authorized():
+                raise Exception("Session is not authorized. Please setup session again.")
+            
+            self.log("✅ Connected to Telegram")
+            
+            # Further accounts share the crawl and its state store; each gets its own budgets and downloader
+            self.pool = SessionPool([Session(self.config["session_path"], self.client)])
+            for session_path in self.config["extra_session_paths"]:
+                session = await self.connect_extra_session(session_path)
+                if session:
+                    self.pool.sessions.append(session)
+            
+            for session in self.pool.sessions:
+                self.metrics.instrument_client(session.client)
+            if int(self.config["metrics_port"]):
+                metrics_server = await self.metrics.serve(int(self.config["metrics_port"]))
+                self.log(f"📈 Metrics at http://127.0.0.1:{self.config['metrics_port']}/metrics")
+            if self.progress_callback:
+                metrics_tasks.append(asyncio.ensure_future(self.report_progress()))
+            if self.config["metrics_snapshot_path"]:
+                metrics_tasks.append(asyncio.ensure_future(self.metrics.snapshot_loop(
+                    self.config["metrics_snapshot_path"], float(self.config["metrics_snapshot_interval"])
+                )))
+            
+            # Scan watermarks and handled codes persist next to the session file
+            self.crawl_state = CrawlState(state_path_for(self.config["session_path"]))
+            # Metadata of every photo and document seen, searchable without Telegram
+            self.mirror = MessageMirror(state_path_for(self.config["session_path"]))
+            
+            # One budget per request class and account, so a FloodWait on searches does not stall downloads
+            for session in self.pool.sessions:
+                session.rate_limiter = RateLimiter(
+                    search_rate=float(self.config["search_requests_per_second"]),
+                    file_rate=float(self.config["file_requests_per_second"]),
+                    log_callback=self.log
+                )
+            self.rate_limiter = self.pool.primary.rate_limiter
+            
+            self.dialogs = await self.load_dialogs()
+            
+            # Create a semaphore to limit concurrent downloads
+            max_downloads = int(self.config["max_concurrent_downloads"])
+            semaphore = asyncio.Semaphore(max_downloads)
+            
+            # Large documents are fetched as parallel byte ranges of chunk_size each
+            for session in self.pool.sessions:
+                session.chunked_downloader = ChunkedDownloader(
+                    session.client,
+                    int(self.config["chunk_size"]),
+                    int(self.config["max_parallel_parts"]),
+                    rate_limiter=session.rate_limiter
+                )
+            self.chunked_downloader = self.pool.primary.chunked_downloader
+            
+            # Downloads start only while their volume has room for them and for everything in flight
+            self.disk_space = DiskSpace(int(self.config["min_free_space_mb"]) * 1024 * 1024, log_callback=self.log)
+            
+            # Finished files are hashed, verified and thumbnailed in a pool while transfers go on
+            self.post_processor = PostProcessor(
+                workers=int(self.config["post_process_workers"]),
+                verify_archives=bool(self.config["verify_archives"]),
+                thumbnails_path=self.config["thumbnails_path"],
+                thumbnail_size=int(self.config["thumbnail_size"])
+            )
+            if self.config["thumbnails_path"] and Image is None:
+                self.log("⚠️ Pillow is not installed, no thumbnails will be created")
+            
+            # Discovery pushes jobs into a bounded scheduler that hands images and small files out first.
+            # It can only reorder what is waiting, so it holds many more jobs than there are workers
+            queue = JobScheduler(
+                maxsize=max(max_downloads * 4, int(self.config["scheduler_window"])),
+                aging_seconds=float(self.config["priority_aging_seconds"])
+            )
+            self.queue = queue
+            self.metrics.register_gauge("queue_depth", queue.qsize)
+            # Archive jobs wait outside the queue until the index is built, so workers keep taking images
+            queue.hold("archive")
+            archive_index_task = asyncio.ensure_future(self.build_archive_index())
+            archive_index_task.add_done_callback(lambda task: self.on_archive_index(task, queue))
+            release_task = asyncio.ensure_future(self.release_archive_jobs(queue, archive_index_task))
+            workers = [
+                asyncio.ensure_future(self.download_worker(queue, archive_index_task, semaphore))
+                for _ in range(max_downloads)
+            ]
+            
+            try:
+                await self.search_and_download_pairs(queue)
+                # Every job is queued now, so the front end can show how far along the run is
+                self.jobs_total = self.jobs_queued
+                # Files that fail verification are queued again, so wait until both stages are idle
+                while True:
+                    await queue.join()
+                    await self.post_processor.join()
+                    if queue.empty():
+                        break
+                if self.config["watch"] and self.is_running:
+                    await self.watch(queue, await archive_index_task)
+            finally:
+                for worker in workers:
+                    worker.cancel()
+                archive_index_task.cancel()
+                release_task.cancel()
+                await asyncio.gather(*workers, archive_index_task, release_task, return_exceptions=True)
+            
+            self.log_query_summary()
+            if self.disk_full:
+                self.log("💾 Run stopped early. Free some disk space and start again to finish the remaining files")
+                self.set_status("Stopped: disk full")
+            else:
+                self.log("✅ Download process completed!")
+                self.set_status("Completed")
+            
+        except asyncio.CancelledError:
+            if not self.stop_requested:
+                raise
+            # Found codes and scan cursors are already stored, and .part files keep their finished ranges
+            self.log_query_summary()
+            if self.paused:
+                self.log("⏸️ Paused. Resuming continues with the unfinished files and the scans where they stopped")
+                self.set_status("Paused")
+            else:
+                self.log("🛑 Stopped. The next start continues where this run stopped")
+                self.set_status("Stopped")
+        except Exception as e:
+            self.log(f"❌ Error in download process: {e}")
+            raise e
+        finally:
+            # A stop from now on has nothing left to cancel
+            self.run_task = None
+            self.stop_requested = False
+            self.is_running = False
+            for task in metrics_tasks:
+                task.cancel()
+            await asyncio.gather(*metrics_tasks, return_exceptions=True)
+            if self.progress_callback:
+                self.progress_callback(self.progress_sample(PROGRESS_INTERVAL))
+            if metrics_server:
+                metrics_server.close()
+            if self.config["metrics_snapshot_path"]:
+                self.metrics.write_snapshot(self.config["metrics_snapshot_path"])
+            self.metrics.close()
+            if self.post_processor:
+                self.post_processor.close()
+                self.post_processor = None
+            if self.crawl_state:
+                self.crawl_state.close()
+                self.crawl_state = None
+            if self.mirror:
+                self.mirror.close()
+                self.mirror = None
+            if self.pool:
+                # The extra accounts are always the engine's own
+                for session in self.pool.sessions[1:]:
+                    await session.client.disconnect()
+            if self.client and self.owns_client:
+                await self.client.disconnect()
+    
+    async def connect_extra_session(self, session_path):
+        """Connect one of the extra accounts, or return None if it cannot be used"""
+        name = os.path.basename(session_path)
+        client = create_client(dict(self.config, session_path=session_path))
+        try:
+            await client.connect()
+            if await client.is_user_authorized():
+                self.log(f"👥 Added session {name}")
+                return Session(session_path, client)
+            self.log(f"⚠️ Session {name} is not authorized, skipping it")
+        except Exception as e:
+            self.log(f"⚠️ Could not connect session {name}: {e}")
+        await client.disconnect()
+        return None
+    
+    async def report_progress(self):
+        """Send a progress sample to the front end every PROGRESS_INTERVAL seconds"""
+        while True:
+            await asyncio.sleep(PROGRESS_INTERVAL)
+            self.progress_callback(self.progress_sample(PROGRESS_INTERVAL))
+    
+    def progress_sample(self, interval):
+        """Return the running transfers and overall progress as plain data for another thread"""
+        transfers = []
+        in_flight = 0
+        for transfer in self.transfers.values():
+            transfer.sample(interval)
+            in_flight += transfer.done
+            transfers.append(transfer.to_dict())
+        
+        # Measured on all bytes, so files that finished between two samples count too
+        bytes_done = self.bytes_completed + in_flight
+        rate = max(0, bytes_done - self.sampled_bytes) / interval
+        self.bytes_per_second = 0.5 * self.bytes_per_second + 0.5 * rate
+        self.sampled_bytes = bytes_done
+        
+        eta = None
+        if self.jobs_total and self.jobs_done:
+            elapsed = time.time() - self.metrics.started_at
+            eta = elapsed / self.jobs_done * (self.jobs_total - self.jobs_done)
+        return {
+            "transfers": transfers,
+            "bytes_done": bytes_done,
+            "bytes_per_second": self.bytes_per_second,
+            "jobs_done": self.jobs_done,
+            "jobs_total": self.jobs_total,
+            "eta_seconds": eta
+        }
+    
+    async def enqueue(self, queue, job):
+        """Queue a download job and count it towards the overall progress"""
+        self.size_job(job)
+        if job.priority is None:
+            job.priority = self.config["query_priorities"].get(job.query)
+        self.jobs_queued += 1
+        if job.kind == "archive":
+            self.queued_archive_codes.add(job.code)
+        if self.jobs_total is not None:
+            # A retry after the job list was complete
+            self.jobs_total += 1
+        await queue.put(job)
+    
+    def size_job(self, job):
+        """Fill in the file size the scheduler orders a job by, if it is known yet"""
+        if job.size is not None:
+            return
+        message = job.message
+        if message is None and job.kind == "archive" and self.archive_index:
+            entry = self.archive_index.get(archive_key(job.code))
+            message = entry[0] if entry else None
+        if message is not None and message.file:
+            job.size = self.expected_size(message)
+    
+    def photo_size_for(self, message):
+        """Return the size of a photo message that image_quality selects, or None for the largest"""
+        return select_photo_size(message.photo, self.image_quality) if message.photo else None
+    
+    def expected_size(self, message):
+        """Return the bytes downloading a message writes: its selected photo size, or the file size"""
+        photo_size = self.photo_size_for(message)
+        if photo_size is not None:
+            return photo_size_bytes(photo_size)
+        return message.file.size if message.file else 0
+    
+    def on_archive_index(self, task, queue):
+        """Size the waiting archive jobs once the index can tell how big their archives are"""
+        if task.cancelled() or task.exception() is not None:
+            return
+        self.archive_index = task.result()
+        for job in queue.pending():
+            self.size_job(job)
+        queue.reprioritize()
+    
+    async def release_archive_jobs(self, queue, archive_index_task):
+        """Hand the held archive jobs to the workers once the index is built, or once building it failed"""
+        await asyncio.wait([archive_index_task])
+        await queue.release("archive")
+    
+    async def load_dialogs(self):
+        """Return the dialogs to search across all sessions, noting which accounts can read each one"""
+        dialogs = {}
+        for session in self.pool.sessions:
+            for dialog in await self.load_session_dialogs(session):
+                # Only channels and supergroups number their messages the same for every account
+                if session is not self.pool.primary and not isinstance(dialog.entity, InputPeerChannel):
+                    continue
+                session.dialogs[dialog.id] = dialog
+                dialogs.setdefault(dialog.id, dialog)
+        
+        dialogs = list(dialogs.values())
+        selected = filter_dialogs(dialogs, self.config["dialog_filters"])
+        self.log(f"💬 Searching {len(selected)} of {len(dialogs)} dialogs")
+        return selected
+    
+    async def load_session_dialogs(self, session):
+        """Return the dialogs of one account, read from its on-disk cache while it is fresh"""
+        cache = DialogCache(
+            dialog_cache_path_for(session.session_path),
+            float(self.config["dialog_cache_ttl"])
+        )
+        dialogs = cache.load()
+        if dialogs is None:
+            self.set_status("Fetching dialog list...")
+            dialogs = [CachedDialog.from_dialog(dialog) async for dialog in self.iter_dialogs(session)]
+            cache.save(dialogs)
+        else:
+            self.log(f"💾 Using cached dialog list of {session.name}")
+        return dialogs
+    
+    async def for_each_dialog(self, scan, phase, dialogs=None):
+        """Run scan(dialog) over the selected dialogs, or the given ones, dialog_parallelism of them at a time"""
+        dialogs = self.dialogs if dialogs is None else dialogs
+        pending_dialogs = iter(dialogs)
+        
+        async def scan_worker():
+            # The iterator is shared, so each worker picks up the next dialog nobody has started
+            for dialog in pending_dialogs:
+                if not self.is_running:
+                    break
+                started = time.monotonic()
+                await scan(dialog)
+                self.metrics.add_dialog_time(phase, dialog.name, time.monotonic() - started)
+        
+        parallelism = max(1, int(self.config["dialog_parallelism"]))
+        workers = [asyncio.ensure_future(scan_worker()) for _ in range(min(parallelism, len(dialogs)))]
+        try:
+            await asyncio.gather(*workers)
+        finally:
+            for worker in workers:
+                worker.cancel()
+            await asyncio.gather(*workers, return_exceptions=True)
+    
+    async def iter_dialogs(self, session):
+        """Iterate an account's dialogs within its search budget, picking up again after a FloodWait"""
+        seen_dialogs = set()
+        while True:
+            try:
+                await session.rate_limiter.acquire(SEARCH_REQUESTS)
+                count = 0
+                async for dialog in session.client.iter_dialogs():
+                    count += 1
+                    if dialog.id not in seen_dialogs:
+                        seen_dialogs.add(dialog.id)
+                        yield dialog
+                    if count % HISTORY_PAGE_SIZE == 0:
+                        await session.rate_limiter.acquire(SEARCH_REQUESTS)
+                return
+            except errors.FloodWaitError as e:
+                session.rate_limiter.on_flood_wait(SEARCH_REQUESTS, e.seconds)
+    
+    async def iter_messages(self, dialog, offset_id=0, **kwargs):
+        """Iterate (session, message) pairs of a dialog below offset_id within the search budget
+
+        After a FloodWait the scan resumes below the last message, with whichever account of the dialog can send soonest"""
+        session = self.pool.pick(dialog.id, SEARCH_REQUESTS)
+        while True:
+            try:
+                await session.rate_limiter.acquire(SEARCH_REQUESTS)
+                count = 0
+                # wait_time=0: the limiter paces the history requests instead of Telethon's fixed sleep
+                async for message in session.client.iter_messages(
+                    session.entity_for(dialog.id), offset_id=offset_id, wait_time=0, **kwargs
+                ):
+                    offset_id = message.id
+                    yield session, message
+                    count += 1
+                    if count % HISTORY_PAGE_SIZE == 0:
+                        await session.rate_limiter.acquire(SEARCH_REQUESTS)
+                return
+            except errors.FloodWaitError as e:
+                session.rate_limiter.on_flood_wait(SEARCH_REQUESTS, e.seconds)
+                other = self.pool.pick(dialog.id, SEARCH_REQUESTS)
+                if other is not session:
+                    self.log(f"🔀 {session.name} is rate limited, scanning {dialog.name} with {other.name}")
+                    session = other
+    
+    async def get_message(self, dialog_id, message_id, session=None):
+        """Fetch a single message by id within the search budget; returns (session, message)"""
+        session = session or self.pool.pick(dialog_id, SEARCH_REQUESTS)
+        message = await session.rate_limiter.call(
+            SEARCH_REQUESTS,
+            lambda: session.client.get_messages(session.entity_for(dialog_id), ids=message_id)
+        )
+        return session, message
+    
+    async def get_messages(self, dialog_id, message_ids, session=None):
+        """Fetch up to a page of messages by id in one request; returns (session, messages) with None for missing ids"""
+        session = session or self.pool.pick(dialog_id, SEARCH_REQUESTS)
+        messages = await session.rate_limiter.call(
+            SEARCH_REQUESTS,
+            lambda: session.client.get_messages(session.entity_for(dialog_id), ids=list(message_ids))
+        )
+        return session, messages
+    
+    async def download_worker(self, queue, archive_index_task, semaphore):
+        """Drain download jobs from the queue until cancelled"""
+        while True:
+            job = await queue.get()
+            try:
+                if not self.is_running:
+                    continue
+                
+                stats = self.query_stats.setdefault(job.query, new_query_stats())
+                queued_seconds = round(time.monotonic() - job.queued_at, 4)
+                with self.metrics.span("job", kind=job.kind, code=job.code, query=job.query,
+                                       queued_seconds=queued_seconds) as span:
+                    if job.kind == "archive":
+                        # Archive jobs reach the workers only after the index task is done, so this does not wait
+                        archive_index = await archive_index_task
+                        archive_found = await self.download_archive_for_code(job.code, job.clean_name, archive_index, semaphore, job)
+                        span["found"] = archive_found
+                        if archive_found:
+                            stats["archives"] += 1
+                        elif not self.disk_full:
+                            stats["missing_archives"] += 1
+                            self.log(f"⚠️ No archive found for code: {job.code}")
+                    elif self.image_quality == METADATA_ONLY:
+                        # Preview only: the photo's metadata is recorded and no bytes are fetched
+                        self.mirror.add(job.message.chat_id, [mirror_entry(job.message, job.code)])
+                        self.crawl_state.mark_image_done(job.code, preview_only=True)
+                        span["success"] = True
+                        self.log(f"🗒️ Recorded image metadata: {os.path.basename(job.file_path)}")
+                    else:
+                        image_success = await self.download_with_progress(
+                            job.message, job.file_path, semaphore, job.kind, job, job.session
+                        )
+                        span["success"] = image_success
+                        if image_success:
+                            stats["images"] += 1
+                            self.crawl_state.mark_image_done(job.code)
+                        elif not self.disk_full:
+                            stats["failed"] += 1
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                self.log(f"🚨 Unexpected error in download worker: {e}")
+            finally:
+                if job.kind == "archive":
+                    self.queued_archive_codes.discard(job.code)
+                self.jobs_done += 1
+                queue.task_done()
+    
+    async def download_with_progress(self, message, file_path, semaphore, file_type="file", job=None, session=None):
+        """Download a single file with progress tracking and error handling
+
+        session is the account the message was fetched with. A file that later fails verification is queued
+        again as job.retry()"""
+        file_path = os.path.abspath(file_path)
+        session = session or self.pool.primary
+        media = media_identity(message)
+        
+        # The same media reposted elsewhere waits for the running transfer and is then linked
+        while media and media[:2] in self.inflight_media:
+            await self.inflight_media[media[:2]].wait()
+        done = asyncio.Event()
+        if media:
+            self.inflight_media[media[:2]] = done
+        
+        reserved_path = None
+        try:
+            async with semaphore:
+                try:
+                    # Media fetched before, under any name, is linked instead of transferred again
+                    known_path = self.crawl_state.find_media(media[0], media[1]) if media else None
+                    if known_path and os.path.exists(known_path):
+                        if known_path != file_path and not os.path.exists(file_path):
+                            link_or_copy(known_path, file_path)
+                            self.log(f"🔗 Linked already downloaded {file_type}: {os.path.basename(file_path)}")
+                        else:
+                            self.log(f"⏭️ Skipping existing {file_type}: {os.path.basename(file_path)}")
+                        return True
+                
+                    # Skip if file already exists; unfinished downloads only exist as .part files
+                    if os.path.exists(file_path) and self.is_same_download(file_path, message, media):
+                        self.log(f"⏭️ Skipping existing {file_type}: {os.path.basename(file_path)}")
+                        return True
+                    if os.path.exists(file_path) or file_path in self.reserved_paths:
+                        # A different file sanitized to the same name
+                        file_path = unique_path(file_path, self.reserved_paths)
+                        self.log(f"✏️ Name already used by another file, saving as: {os.path.basename(file_path)}")
+                    reserved_path = file_path
+                    self.reserved_paths[reserved_path] = media
+                
+                    # Wait for room on the volume, then download the file
+                    size = self.expected_size(message)
+                    await self.disk_space.reserve(part_path_for(file_path), size)
+                    started = time.monotonic()
+                    transfer = Transfer(os.path.basename(file_path), file_type, size)
+                    self.transfers[file_path] = transfer
+                    self.metrics.active_downloads += 1
+                    try:
+                        await self.fetch_media(session, message, file_path, transfer)
+                    finally:
+                        self.metrics.active_downloads -= 1
+                        del self.transfers[file_path]
+                        self.disk_space.release(part_path_for(file_path))
+                    self.bytes_completed += os.path.getsize(file_path)
+                    self.metrics.record_file(
+                        file_type, os.path.basename(file_path), os.path.getsize(file_path), time.monotonic() - started
+                    )
+                
+                    # Cataloged right away so reposts of this media link to it; the hash follows
+                    if media:
+                        media_type, media_id, access_hash, size = media
+                        self.crawl_state.add_media(media_type, media_id, access_hash, size, file_path, None)
+                    self.post_processor.submit(
+                        file_path, file_type,
+                        lambda result: self.after_post_process(result, media, file_type, job)
+                    )
+                
+                    if file_type == "image":
+                        self.downloaded_images += 1
+                    else:
+                        self.downloaded_archives += 1
+                    
+                    self.update_stats()
+                    self.log(f"📥 Downloaded {file_type}: {os.path.basename(file_path)}")
+                    return True
+                
+                except Exception as e:
+                    if is_disk_full(e):
+                        self.on_disk_full(file_path, e)
+                        return False
+                    self.failed_downloads += 1
+                    self.metrics.record_failure(file_type)
+                    self.update_stats()
+                    self.log(f"❌ Failed to download {file_type} {os.path.basename(file_path)}: {e}")
+                    return False
+        finally:
+            self.reserved_paths.pop(reserved_path, None)
+            if media:
+                del self.inflight_media[media[:2]]
+            done.set()
+    
+    def on_disk_full(self, file_path, error):
+        """Stop starting downloads once the volume is full, instead of failing every remaining file"""
+        if self.disk_full:
+            return
+        self.disk_full = True
+        self.log(
+            f"💾 Disk full while writing {os.path.basename(file_path)} ({error.strerror}). "
+            f"Stopping new downloads; unfinished files resume on the next run"
+        )
+        self.set_status("Stopped: disk full")
+        # Transfers already running may still fit, so they finish; only new ones are held back
+        self.is_running = False
+    
+    async def fetch_media(self, session, message, file_path, transfer):
+        """Transfer a message's media, moving to another account of the dialog while this one is throttled"""
+        failover_after = float(self.config["session_failover_after"])
+        while True:
+            max_pause = None
+            if session.paused_for(FILE_REQUESTS):
+                previous = session
+                session, message = await self.switch_session(session, message)
+                if session is previous:
+                    # Nobody is less throttled, so this account sits the pause out
+                    failover_after = None
+            # A long pause is only handed over while another account of the dialog could take the download
+            if failover_after is not None and self.pool.has_spare(message.chat_id, FILE_REQUESTS, session, failover_after):
+                max_pause = failover_after
+            try:
+                if message.document and message.file and message.file.size:
+                    await session.chunked_downloader.download(
+                        message, file_path, progress_callback=transfer.update, max_pause=max_pause
+                    )
+                else:
+                    part_path = part_path_for(file_path)
+                    # Photo sizes are asked for by type; None is the largest photo size, or the whole document
+                    photo_size = self.photo_size_for(message)
+                    thumb = photo_size.type if photo_size is not None else None
+                    download = lambda: session.client.download_media(
+                        message.media, file=part_path, progress_callback=transfer.update, thumb=thumb
+                    )
+                    if isinstance(photo_size, INLINE_SIZES):
+                        # The bytes come with the message, so nothing is sent
+                        await download()
+                    else:
+                        await session.rate_limiter.call(FILE_REQUESTS, download, max_pause=max_pause)
+                    # Photo sizes are not known exactly up front, so only the rename is checked here
+                    finalize_part(part_path, file_path, None)
+                return
+            except SessionThrottled:
+                # The .part journal lets the next account resume where this one stopped
+                continue
+    
+    async def switch_session(self, session, message):
+        """Return a less throttled account of the message's dialog and the message as that account sees it"""
+        other = self.pool.pick(message.chat_id, FILE_REQUESTS, exclude=(session,))
+        if other is None or other.paused_for(FILE_REQUESTS) >= session.paused_for(FILE_REQUESTS):
+            return session, message
+        # File references belong to the account that fetched the message, so the other account fetches it again
+        _, fresh = await self.get_message(message.chat_id, message.id, other)
+        if fresh is None or fresh.media is None:
+            return session, message
+        self.log(f"🔀 {session.name} is rate limited, continuing the download with {other.name}")
+        return other, fresh
+    
+    def is_same_download(self, file_path, message, media):
+        """Tell whether an existing file holds this message's media rather than another file with the same name"""
+        owner = self.crawl_state.path_owner(file_path)
+        if owner is not None:
+            return media is not None and tuple(owner) == media[:2]
+        # Files from before the catalog existed: trust them unless the document size disagrees
+        if message.document and message.file and message.file.size:
+            return os.path.getsize(file_path) == message.file.size
+        return True
+    
+    async def after_post_process(self, result, media, file_type, job):
+        """Catalog a verified file, or remove a corrupt one and queue it for download again"""
+        file_name = os.path.basename(result.path)
+        try:
+            if result.thumbnail_error:
+                self.log(f"⚠️ Could not create thumbnail for {file_name}: {result.thumbnail_error}")
+            if result.unverified:
+                self.log(f"⚠️ Kept {file_name} without verifying it: {result.unverified}")
+            if result.error is None:
+                self.catalog_download(result.path, media, file_type, result.sha256)
+                return
+            
+            self.log(f"❌ {file_type.capitalize()} failed verification: {file_name}: {result.error}")
+            if os.path.exists(result.path):
+                os.remove(result.path)
+            self.crawl_state.remove_media(result.path)
+            if file_type == "image":
+                self.downloaded_images -= 1
+            else:
+                self.downloaded_archives -= 1
+            
+            if job is not None:
+                stats = self.query_stats.setdefault(job.query, new_query_stats())
+                stats[file_type + "s"] -= 1
+                # Until the new copy is in place, an interrupted run has to fetch this file again
+                self.crawl_state.reset_download(job.code, file_type)
+                if job.attempt < int(self.config["verify_retries"]) and self.is_running:
+                    self.log(f"🔁 Downloading {file_name} again (attempt {job.attempt + 2})")
+                    await self.enqueue(self.queue, job.retry())
+                else:
+                    stats["failed"] += 1
+                    self.failed_downloads += 1
+            else:
+                self.failed_downloads += 1
+            self.update_stats()
+        except Exception as e:
+            self.log(f"🚨 Unexpected error checking {file_name}: {e}")
+    
+    def catalog_download(self, file_path, media, file_type, sha256):
+        """Record a completed file and hard-link it to an identical earlier file"""
+        for other_path in self.crawl_state.find_by_hash(sha256):
+            if other_path == file_path or not os.path.exists(other_path):
+                continue
+            try:
+                tmp_path = file_path + ".link"
+                os.link(other_path, tmp_path)
+                os.replace(tmp_path, file_path)
+                self.log(f"🔗 Same content as {os.path.basename(other_path)}, stored {file_type} as a hard link")
+            except OSError:
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+            break
+        
+        if media:
+            media_type, media_id, access_hash, size = media
+            self.crawl_state.add_media(media_type, media_id, access_hash, size, file_path, sha256)
+    
+    async def build_archive_index(self):
+        """Scan new archive documents once per dialog and index them by code"""
+        archive_index = {}
+        counters = {"scanned": 0}
+        
+        await self.for_each_dialog(lambda dialog: self.index_dialog_archives(dialog, archive_index, counters), "index")
+        
+        self.log(f"🗂️ Indexed {counters['scanned']} new archives under {len(archive_index)} keys")
+        return archive_index
+    
+    async def index_dialog_archives(self, dialog, archive_index, counters):
+        """Add the new archive documents of one dialog to the index, continuing an interrupted scan first
+
+        Returns True once the dialog is indexed up to its newest document"""
+        async def index_page(page):
+            page_keys = set()
+            page_entries = []
+            documents = []
+            for session, message in page:
+                if not (message.media and message.document):
+                    continue
+                documents.append(mirror_entry(message))
+                complete_file_name = ""
+                if hasattr(message, 'file') and message.file and hasattr(message.file, 'name'):
+                    complete_file_name = message.file.name or ''
+                
+                keys = archive_index_keys(complete_file_name, message.text)
+                if keys:
+                    counters["scanned"] += 1
+                # Newest message wins, matching the order of a server-side search
+                for key in keys:
+                    archive_index.setdefault(key, (message, session))
+                    if key not in page_keys:
+                        page_keys.add(key)
+                        page_entries.append((key, dialog.id, message.id))
+            self.crawl_state.add_archive_keys(page_entries)
+            self.mirror.add(dialog.id, documents)
+        
+        try:
+            # Archives up to the watermark were indexed by earlier runs and live in the state store
+            return await self.scan_history(
+                dialog, ARCHIVE_SCAN_QUERY,
+                lambda: self.crawl_state.get_max_id(dialog.id, ARCHIVE_SCAN_QUERY),
+                lambda max_id: self.crawl_state.set_max_id(dialog.id, ARCHIVE_SCAN_QUERY, max_id),
+                index_page, filter=InputMessagesFilterDocument
+            )
+        except errors.RPCError as e:
+            self.log(f"⚠️ RPC Error indexing {dialog.name}: {e}")
+        except Exception as e:
+            self.log(f"🚨 Unexpected error indexing {dialog.name}: {e}")
+        return False
+    
+    async def requeue_unfinished_codes(self, queue):
+        """Queue the images and archives that earlier runs found but did not finish"""
+        by_dialog = {}
+        # Images recorded as metadata only are fetched once a run asks for their bytes
+        for row in self.crawl_state.unfinished_codes(include_previews=self.image_quality != METADATA_ONLY):
+            by_dialog.setdefault(row[2], []).append(row)
+        
+        # Image messages are fetched a page of ids per request instead of one request per code
+        for dialog_id, rows in by_dialog.items():
+            for start in range(0, len(rows), HISTORY_PAGE_SIZE):
+                if not self.is_running:
+                    return
+                await self.requeue_codes(dialog_id, rows[start:start + HISTORY_PAGE_SIZE], queue)
+    
+    async def requeue_codes(self, dialog_id, rows, queue):
+        """Queue the jobs of unfinished codes whose images were found in one dialog"""
+        try:
+            missing = {0} if self.image_quality == METADATA_ONLY else {0, IMAGE_PREVIEW_ONLY}
+            message_ids = [message_id for _, _, _, message_id, image_done, _ in rows if image_done in missing]
+            session, messages = await self.get_messages(dialog_id, message_ids) if message_ids else (None, [])
+            found = {message.id: message for message in messages if message}
+            
+            for code, clean_name, _, message_id, image_done, archive_done in rows:
+                message = found.get(message_id) if image_done in missing else None
+                if message and message.photo:
+                    image_path = self.image_path_for(message, clean_name)
+                    await self.enqueue(queue, DownloadJob("image", message=message, file_path=image_path, code=code,
+                                                          query=RESUMED_QUERY, session=session))
+                if not archive_done:
+                    await self.enqueue(queue, DownloadJob("archive", code=code, clean_name=clean_name, query=RESUMED_QUERY,
+                                                          dialog_id=dialog_id))
+        except errors.RPCError as e:
+            self.log(f"⚠️ RPC Error resuming codes found in dialog {dialog_id}: {e}")
+        except Exception as e:
+            self.log(f"🚨 Unexpected error resuming codes found in dialog {dialog_id}: {e}")
+    
+    async def queue_found_archives(self, keys, queue):
+        """Queue the archives of codes that were still waiting for one, now that keys are indexed"""
+        for code, clean_name in self.crawl_state.codes_missing_archive().items():
+            if archive_key(code) in keys and code not in self.queued_archive_codes:
+                await self.enqueue(queue, DownloadJob("archive", code=code, clean_name=clean_name, query=WATCH_QUERY))
+    
+    def image_path_for(self, message, clean_name):
+        """Return the download path of an image"""
+        file_ext = ".jpg"
+        if hasattr(message, 'file') and message.file and hasattr(message.file, 'ext'):
+            file_ext = message.file.ext or ".jpg"
+        
+        return os.path.join(self.config["images_path"], clean_name + file_ext)
+    
+    async def search_and_download_pairs(self, queue):
+        """Search new messages for images and queue them together with their archive lookups"""
+        queries = resolve_queries(self.config)
+        self.query_stats = {query: new_query_stats() for query in queries}
+        # Codes handled by earlier runs are skipped; unfinished ones are requeued first
+        processed_codes = self.crawl_state.known_codes()
+        
+        self.set_status("Searching and downloading...")
+        await self.requeue_unfinished_codes(queue)
+        
+        # One pass over the dialogs runs the whole query set in each of them
+        await self.for_each_dialog(lambda dialog: self.search_dialog_queries(dialog, queries, processed_codes, queue), "search")
+    
+    async def search_dialog_queries(self, dialog, queries, processed_codes, queue):
+        """Run every query of the job against one dialog, answering from the local mirror as far as it reaches
+
+        Returns True once every query has searched the dialog up to its newest post"""
+        coverage = self.mirror.photo_coverage(dialog.id)
+        finished = True
+        for search_name in queries:
+            if not self.is_running:
+                return False
+            finished &= await self.search_mirror(dialog, search_name, coverage, processed_codes, queue)
+        
+        if self.config["mirror_photos"]:
+            # One scan of the new photos answers every query, instead of a server-side search per query
+            return await self.scan_dialog_photos(dialog, queries, processed_codes, queue) and finished
+        for search_name in queries:
+            if not self.is_running:
+                return False
+            finished &= await self.search_dialog(dialog, search_name, processed_codes, queue)
+        return finished
+    
+    async def search_mirror(self, dialog, search_name, coverage, processed_codes, queue):
+        """Queue the mirrored photos that match a query, from its watermark up to where the mirror holds every photo"""
+        min_id = self.crawl_state.get_max_id(dialog.id, search_name)
+        if coverage <= min_id:
+            return True
+        try:
+            rows = self.mirror.search(search_name, dialog_id=dialog.id, kind=PHOTO, min_id=min_id, max_id=coverage)
+            # Parsed again, as the code rule may have changed since the photos were mirrored
+            parsed = self.caption_parser.parse_many([mirrored_caption(row) for row in rows])
+            # Only photos with a new code are fetched, for a current file reference
+            message_ids = [row["message_id"] for row, (code, _) in zip(rows, parsed) if code and code not in processed_codes]
+            for start in range(0, len(message_ids), HISTORY_PAGE_SIZE):
+                if not self.is_running:
+                    return False
+                session, messages = await self.get_messages(dialog.id, message_ids[start:start + HISTORY_PAGE_SIZE])
+                page = [(session, message) for message in messages if message and message.photo]
+                await self.queue_search_page(dialog, search_name, page, processed_codes, queue)
+            self.crawl_state.set_max_id(dialog.id, search_name, coverage)
+            return True
+        except errors.RPCError as e:
+            self.log(f"⚠️ RPC Error answering {search_name} from the mirror in {dialog.name}: {e}")
+        except Exception as e:
+            self.log(f"🚨 Unexpected error answering {search_name} from the mirror in {dialog.name}: {e}")
+        return False
+    
+    async def scan_dialog_photos(self, dialog, queries, processed_codes, queue):
+        """Mirror the new photos of one dialog and queue those matching a query, continuing an interrupted scan first"""
+        async def photo_page(page):
+            photos = [(session, message) for session, message in page if message.photo]
+            await self.queue_photo_page(dialog, queries, photos, processed_codes, queue)
+        
+        try:
+            # Photos up to the watermark are in the mirror already
+            finished = await self.scan_history(
+                dialog, PHOTO_SCAN_QUERY,
+                lambda: self.mirror.photo_coverage(dialog.id),
+                lambda max_id: self.mirror.set_photo_coverage(dialog.id, max_id),
+                photo_page, filter=InputMessagesFilterPhotos
+            )
+            if finished:
+                # Moves each query's watermark up to the new coverage; queries added while a scan
+                # was interrupted also get the photos it had passed
+                coverage = self.mirror.photo_coverage(dialog.id)
+                for search_name in queries:
+                    finished &= await self.search_mirror(dialog, search_name, coverage, processed_codes, queue)
+            return finished
+        
+        except errors.RPCError as e:
+            self.log(f"⚠️ RPC Error scanning photos of {dialog.name}: {e}")
+        except Exception as e:
+            self.log(f"🚨 Unexpected error scanning photos of {dialog.name}: {e}")
+        return False
+    
+    async def queue_photo_page(self, dialog, queries, page, processed_codes, queue):
+        """Mirror a page of (session, photo message) pairs and queue the photos that match a query"""
+        parsed = self.caption_parser.parse_many([caption_for(message) for _, message in page])
+        self.mirror.add(dialog.id, [
+            mirror_entry(message, code, clean_name) for (_, message), (code, clean_name) in zip(page, parsed)
+        ])
+        for search_name in queries:
+            matches = [index for index, (_, message) in enumerate(page) if matches_query(search_name, message)]
+            if matches:
+                await self.queue_search_page(dialog, search_name, [page[index] for index in matches], processed_codes, queue,
+                                             parsed=[parsed[index] for index in matches])
+    
+    async def watch(self, queue, archive_index):
+        """Queue new posts of the selected dialogs as they arrive, until stopped"""
+        queries = resolve_queries(self.config)
+        processed_codes = self.crawl_state.known_codes()
+        dialogs_by_id = {dialog.id: dialog for dialog in self.dialogs}
+        
+        handlers = []
+        for session in self.pool.sessions:
+            # Each dialog is watched by one account only, so a post is not handled twice
+            chats = [session.entity_for(dialog.id) for dialog in self.dialogs if self.pool.members(dialog.id)[0] is session]
+            if not chats:
+                continue
+            handler = functools.partial(
+                self.on_new_message, session, dialogs_by_id, queries, processed_codes, archive_index, queue
+            )
+            session.client.add_event_handler(handler, events.NewMessage(chats=chats))
+            handlers.append((session, handler))
+        
+        all_dialogs = {dialog.id for dialog in self.dialogs}
+        retry_at = 0.0
+        try:
+            # Posts from between the search and the handlers going live are picked up like after a reconnect
+            self.watch_gaps = set(all_dialogs)
+            self.log(f"👀 Watching {len(self.dialogs)} dialogs for new posts")
+            while self.is_running:
+                disconnected = [session for session in self.pool.sessions if not session.client.is_connected()]
+                if disconnected:
+                    if self.watch_gaps != all_dialogs:
+                        self.log("🔌 Connection lost, reconnecting...")
+                        self.watch_gaps = set(all_dialogs)
+                        retry_at = 0.0
+                    for session in disconnected:
+                        try:
+                            await session.client.connect()
+                        except Exception as e:
+                            logger.debug(f"Reconnecting {session.name} failed: {e}")
+                elif self.watch_gaps and time.monotonic() >= retry_at:
+                    self.set_status("Catching up on missed posts...")
+                    gap_dialogs = [dialog for dialog in self.dialogs if dialog.id in self.watch_gaps]
+                    caught_up = await self.catch_up(gap_dialogs, queries, processed_codes, archive_index, queue)
+                    # Only dialogs whose own scans all finished may move their watermarks with new posts
+                    self.watch_gaps -= caught_up
+                    if self.watch_gaps and self.is_running:
+                        self.log(f"⚠️ {len(self.watch_gaps)} dialogs not caught up, retrying in {CATCH_UP_RETRY_INTERVAL:.0f} seconds")
+                        retry_at = time.monotonic() + CATCH_UP_RETRY_INTERVAL
+                    self.set_status("Watching for new posts...")
+                await asyncio.sleep(WATCH_CHECK_INTERVAL)
+        finally:
+            for session, handler in handlers:
+                session.client.remove_event_handler(handler)
+    
+    async def catch_up(self, dialogs, queries, processed_codes, archive_index, queue):
+        """Scan only the posts after the watermarks of the given dialogs, as the next run would
+
+        Returns the ids of the dialogs whose index and search scans all finished"""
+        counters = {"scanned": 0}
+        indexed = set()
+        searched = set()
+        
+        async def index(dialog):
+            if await self.index_dialog_archives(dialog, archive_index, counters):
+                indexed.add(dialog.id)
+        
+        async def search(dialog):
+            if await self.search_dialog_queries(dialog, queries, processed_codes, queue):
+                searched.add(dialog.id)
+        
+        await self.for_each_dialog(index, "index", dialogs)
+        await self.queue_found_archives(archive_index, queue)
+        await self.for_each_dialog(search, "search", dialogs)
+        return indexed & searched
+    
+    async def on_new_message(self, session, dialogs_by_id, queries, processed_codes, archive_index, queue, event):
+        """Run the code extraction and archive matching on one incoming post and queue its downloads"""
+        dialog = dialogs_by_id.get(event.chat_id)
+        message = event.message
+        if dialog is None or not self.is_running:
+            return
+        
+        try:
+            if message.document:
+                file_name = (message.file.name if message.file else None) or ""
+                keys = archive_index_keys(file_name, message.text)
+                if keys:
+                    # Newest post wins, as in the index scan
+                    for key in keys:
+                        archive_index[key] = (message, session)
+                    self.crawl_state.add_archive_keys([(key, dialog.id, message.id) for key in keys])
+                    self.log(f"🗂️ New archive in {dialog.name}: {file_name}")
+                    await self.queue_found_archives(keys, queue)
+                self.mirror.add(dialog.id, [mirror_entry(message)])
+            elif message.photo:
+                # Mirrored and matched like a page of the photo scan
+                await self.queue_photo_page(dialog, queries, [(session, message)], processed_codes, queue)
+            
+            if dialog.id not in self.watch_gaps:
+                # Every post up to this one has been handled, so a restart only scans what comes after it
+                for query in queries + [ARCHIVE_SCAN_QUERY]:
+                    self.crawl_state.set_max_id(dialog.id, query, message.id)
+                if self.config["mirror_photos"]:
+                    self.mirror.set_photo_coverage(dialog.id, message.id)
+        except errors.RPCError as e:
+            self.log(f"⚠️ RPC Error handling new post in {dialog.name}: {e}")
+        except Exception as e:
+            self.log(f"🚨 Unexpected error handling new post in {dialog.name}: {e}")
+    
+    def log_query_summary(self):
+        """Log what each query of the job found and downloaded"""
+        if len(self.query_stats) < 2 and RESUMED_QUERY not in self.query_stats:
+            return
+        for query, stats in self.query_stats.items():
+            self.log(
+                f"📊 {query}: {stats['found']} found | Images: {stats['images']} | "
+                f"Archives: {stats['archives']} | No archive: {stats['missing_archives']} | Failed: {stats['failed']}"
+            )
+    
+    async def search_dialog(self, dialog, search_name, processed_codes, queue):
+        """Search one dialog for new images and queue them, continuing an interrupted scan first
+
+        Returns True once the dialog is searched up to its newest post"""
+        async def search_page(page):
+            # Photos are parsed a page at a time, in step with the history requests
+            photos = [(session, message) for session, message in page if message.media and message.photo]
+            await self.queue_search_page(dialog, search_name, photos, processed_codes, queue)
+        
+        try:
+            # Search for images newer than the last scan of this dialog
+            return await self.scan_history(
+                dialog, search_name,
+                lambda: self.crawl_state.get_max_id(dialog.id, search_name),
+                lambda max_id: self.crawl_state.set_max_id(dialog.id, search_name, max_id),
+                search_page, search=search_name
+            )
+        except errors.RPCError as e:
+            self.log(f"⚠️ RPC Error in {dialog.name}: {e}")
+        except Exception as e:
+            self.log(f"🚨 Unexpected error in {dialog.name}: {e}")
+        return False
+    
+    async def scan_history(self, dialog, scan_name, get_watermark, set_watermark, on_page, **kwargs):
+        """Hand the messages of a dialog newer than its watermark to on_page a page at a time, then move the watermark
+
+        iter_messages gets kwargs. A stopped scan picks up below the last page handled, unless the watermark has
+        moved since, and is followed by a scan of the posts that arrived after it started. Returns True once the
+        dialog is scanned up to its newest post, False when the run stopped first"""
+        while True:
+            min_id = get_watermark()
+            max_id = min_id
+            offset_id = 0
+            cursor = self.crawl_state.get_cursor(dialog.id, scan_name)
+            if cursor and cursor[0] == min_id:
+                _, offset_id, max_id = cursor
+            
+            page = []
+            async for session, message in self.iter_messages(dialog, offset_id=offset_id, min_id=min_id, **kwargs):
+                if not self.is_running:
+                    return False
+                max_id = max(max_id, message.id)
+                page.append((session, message))
+                if len(page) == HISTORY_PAGE_SIZE:
+                    await on_page(page)
+                    page = []
+                    # Everything down to this message is handled
+                    self.crawl_state.set_cursor(dialog.id, scan_name, min_id, message.id, max_id)
+            
+            # Only a fully scanned dialog may move its watermark forward
+            await on_page(page)
+            set_watermark(max_id)
+            self.crawl_state.clear_cursor(dialog.id, scan_name)
+            if not offset_id:
+                return True
+            # The interrupted scan is done; next come the posts that arrived after it started
+    
+    async def queue_search_page(self, dialog, search_name, page, processed_codes, queue, parsed=None):
+        """Parse the captions of a page of (session, photo message) pairs and queue the ones with new codes
+
+        A page the caller has parsed comes with its results in parsed and is already mirrored"""
+        if parsed is None:
+            parsed = self.caption_parser.parse_many([caption_for(message) for _, message in page])
+            self.mirror.add(dialog.id, [
+                mirror_entry(message, code, clean_name) for (_, message), (code, clean_name) in zip(page, parsed)
+            ])
+        for (session, message), (code, clean_name) in zip(page, parsed):
+            # Check and add run without an await in between, so parallel dialogs never claim the same code twice
+            if not code or code in processed_codes:
+                continue
+            
+            processed_codes.add(code)
+            self.query_stats[search_name]["found"] += 1
+            # Recorded before queueing so an interrupted run picks the code up again
+            self.crawl_state.add_code(code, clean_name, dialog.id, message.id)
+            
+            image_path = self.image_path_for(message, clean_name)
+            
+            self.log(f"🔍 Found image with code: {code}")
+            
+            # Queue the image and its archive lookup as separate jobs
+            await self.enqueue(queue, DownloadJob("image", message=message, file_path=image_path, code=code,
+                                                  query=search_name, session=session))
+            await self.enqueue(queue, DownloadJob("archive", code=code, clean_name=clean_name, query=search_name,
+                                                  dialog_id=dialog.id))
+    
+    async def download_archive_for_code(self, code, file_name, archive_index, semaphore, job=None):
+        """Download the indexed archive for a specific code"""
+        key = archive_key(code)
+        entry = archive_index.get(key)
+        if entry is None:
+            # Fall back to archives indexed by earlier runs
+            location = self.crawl_state.find_archive(key)
+            if location is None:
+                return False
+            dialog_id, message_id = location
+            session, message = await self.get_message(dialog_id, message_id)
+            if message is None or not message.document:
+                return False
+        else:
+            message, session = entry
+        
+        ext = os.path.splitext(message.file.name)[1] or ".rar"
+        archive_path = os.path.join(self.config["archives_path"], file_name + ext)
+        
+        success = await self.download_with_progress(message, archive_path, semaphore, "archive", job, session)
+        if success:
+            self.crawl_state.mark_archive_done(code, message.chat_id, message.id)
+        return success
+
+
+class DownloadJob:
+    """A unit of work for the download workers"""
+    def __init__(self, kind, message=None, file_path=None, code=None, clean_name=None, query=None, attempt=0,
+                 session=None, dialog_id=None, size=None, priority=None):
+        self.kind = kind
+        self.query = query
+        self.message = message
+        # The account that fetched message, whose file reference the download uses
+        self.session = session
+        # Scheduling: the source dialog takes turns with the others; priority replaces the size-based score
+        self.dialog_id = dialog_id if dialog_id is not None else getattr(message, "chat_id", None)
+        self.size = size
+        self.priority = priority
+        self.file_path = file_path
+        self.code = code
+        self.clean_name = clean_name
+        self.queued_at = time.monotonic()
+        self.attempt = attempt
+    
+    def retry(self):
+        """Return this job again for a new download of a file that failed verification"""
+        return DownloadJob(
+            self.kind, self.message, self.file_path, self.code, self.clean_name, self.query, self.attempt + 1,
+            session=self.session, dialog_id=self.dialog_id, size=self.size, priority=self.priority
+        )
+
+
+class Transfer:
+    """Byte progress of one running download, sampled for the front end"""
+    def __init__(self, name, kind, total):
+        self.name = name
+        self.kind = kind
+        self.total = total or 0
+        self.done = 0
+        self.sampled_done = 0
+        self.bytes_per_second = 0.0
+    
+    def update(self, done, total):
+        """Progress callback in the form Telethon calls it"""
+        self.done = done
+        if total:
+            self.total = total
+    
+    def sample(self, interval):
+        # Exponential smoothing keeps the rate readable when chunks arrive in bursts
+        rate = (self.done - self.sampled_done) / interval
+        self.bytes_per_second = rate if not self.sampled_done else 0.5 * self.bytes_per_second + 0.5 * rate
+        self.sampled_done = self.done
+    
+    def to_dict(self):
+        remaining = max(0, self.total - self.done)
+        return {
+            "name": self.name,
+            "kind": self.kind,
+            "done": self.done,
+            "total": self.total,
+            "bytes_per_second": self.bytes_per_second,
+            "eta_seconds": remaining / self.bytes_per_second if self.bytes_per_second else None
+        }
@@ -0,0 +1,54 @@
+import os
+
+
+class Session:
+    """One account of the pool: its client, request budgets, downloader and view of the dialogs"""
+    def __init__(self, session_path, client, rate_limiter=None, chunked_downloader=None):
+        self.session_path = session_path
+        self.name = os.path.basename(session_path)
+        self.client = client
+        self.rate_limiter = rate_limiter
+        self.chunked_downloader = chunked_downloader
+        # Dialog id -> CachedDialog holding this account's own entity (access hashes differ per account)
+        self.dialogs = {}
+
+    def entity_for(self, dialog_id):
+        """Return this account's input peer for a dialog, or the bare id for Telethon to resolve"""
+        dialog = self.dialogs.get(dialog_id)
+        return dialog.entity if dialog is not None else dialog_id
+
+    def paused_for(self, request_class):
+        return self.rate_limiter.paused_for(request_class)
+
+
+class SessionPool:
+    """Accounts that share the crawl; each request goes to a member of the dialog that can send soonest"""
+    def __init__(self, sessions):
+        self.sessions = sessions
+        self.turn = 0
+
+    @property
+    def primary(self):
+        return self.sessions[0]
+
+    def members(self, dialog_id):
+        """Return the sessions that can read a dialog; the primary session for dialogs nobody listed"""
+        return [session for session in self.sessions if dialog_id in session.dialogs] or [self.primary]
+
+    def pick(self, dialog_id, request_class, exclude=()):
+        """Return the least throttled member, rotating between equally free ones, or None"""
+        candidates = [session for session in self.members(dialog_id) if session not in exclude]
+        if not candidates:
+            return None
+        # Rotating the start spreads new work over the accounts; min() keeps the first of equals
+        self.turn += 1
+        start = self.turn % len(candidates)
+        rotated = candidates[start:] + candidates[:start]
+        return min(rotated, key=lambda session: session.paused_for(request_class))
+
+    def has_spare(self, dialog_id, request_class, session, within):
+        """Tell whether another member of the dialog can send within the given number of seconds"""
+        return any(
+            other is not session and other.paused_for(request_class) < within
+            for other in self.members(dialog_id)
+        )
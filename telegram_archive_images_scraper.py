@@ -1,18 +1,55 @@
 import tkinter as tk
 from tkinter import ttk, filedialog, messagebox, scrolledtext
-import threading
 import asyncio
+import concurrent.futures
+import queue
 import json
 import os
-import re
-from telethon import TelegramClient, errors
+import sqlite3
+from telethon import errors
+from scraper_engine import ScraperEngine
+from crawl_state import CrawlState, state_path_for
+from message_mirror import MessageMirror
+from photo_sizes import parse_image_quality
+from client_runner import ClientRunner
 from pathlib import Path
 import time
 import logging
+import logging.handlers
 
 # Set up logging to help with debugging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
+# The log widget keeps only the most recent lines; the full log goes to a rotating file
+LOG_MAX_LINES = 5000
+LOG_FILE = "telegram_downloader.log"
+LOG_FILE_MAX_BYTES = 5 * 1024 * 1024
+LOG_FILE_BACKUPS = 3
+
+# How often the Tk thread applies queued log lines and stats (10 frames per second)
+UI_REFRESH_MS = 100
+
+# Rows of the active transfers table that are visible without scrolling
+TRANSFER_ROWS = 6
+
+
+def format_bytes(size):
+    """Return a byte count as a short human readable string"""
+    for unit in ("B", "KB", "MB", "GB"):
+        if size < 1024 or unit == "GB":
+            return f"{size:.0f} {unit}" if unit == "B" else f"{size:.1f} {unit}"
+        size /= 1024
+
+
+def format_eta(seconds):
+    """Return seconds as m:ss or h:mm:ss, or a dash when unknown"""
+    if seconds is None:
+        return "–"
+    seconds = int(seconds)
+    hours, rest = divmod(seconds, 3600)
+    minutes, seconds = divmod(rest, 60)
+    return f"{hours}:{minutes:02d}:{seconds:02d}" if hours else f"{minutes}:{seconds:02d}"
+
 class TelegramDownloaderGUI:
     def __init__(self, root):
         self.root = root
@@ -29,15 +66,27 @@ class TelegramDownloaderGUI:
         self.phone_number = tk.StringVar()
         self.session_path = tk.StringVar()
         self.search_query = tk.StringVar()
+        self.queries_file = tk.StringVar()
+        self.watch = tk.BooleanVar(value=False)
+        self.mirror_photos = tk.BooleanVar(value=False)
         self.images_path = tk.StringVar()
         self.archives_path = tk.StringVar()
         
         # Performance settings
         self.max_concurrent_downloads = tk.IntVar(value=3)
         self.chunk_size = tk.IntVar(value=1024*1024)  # 1MB chunks
+        self.max_parallel_parts = tk.IntVar(value=8)
+        self.dialog_parallelism = tk.IntVar(value=3)
+        self.image_quality = tk.StringVar(value="largest")
+        
+        # The engine of the current run, if any
+        self.engine = None
         
-        # Initialize client as None
-        self.client = None
+        # One event loop thread keeps the Telegram client connected between actions
+        self.runner = ClientRunner()
+        
+        # Settings from config.json without a form field (e.g. rate limits) are kept as loaded
+        self.extra_config = {}
         self.is_running = False
         
         # Statistics
@@ -45,8 +94,14 @@ class TelegramDownloaderGUI:
         self.downloaded_archives = 0
         self.failed_downloads = 0
         
+        # Worker threads never touch widgets; they queue events for the Tk thread instead
+        self.ui_events = queue.Queue()
+        self.file_logger = self._create_file_logger()
+        
         self.create_widgets()
         self.load_config()
+        self.root.after(UI_REFRESH_MS, self._drain_ui_events)
+        self.root.protocol("WM_DELETE_WINDOW", self.on_close)
         
     def create_widgets(self):
         # Main frame with scrollbar
@@ -89,6 +144,17 @@ class TelegramDownloaderGUI:
         chunk_spin = ttk.Spinbox(perf_frame, from_=1, to=10, textvariable=self.chunk_mb, width=10)
         chunk_spin.grid(row=1, column=1, sticky=tk.W, padx=(10, 0), pady=5)
         chunk_spin.bind('<Return>', lambda e: self.chunk_size.set(self.chunk_mb.get() * 1024 * 1024))
+        self.chunk_mb.trace_add('write', lambda *args: self._sync_chunk_size())
+        
+        ttk.Label(perf_frame, text="Parallel Parts (all files):").grid(row=2, column=0, sticky=tk.W, pady=5)
+        ttk.Spinbox(perf_frame, from_=1, to=32, textvariable=self.max_parallel_parts, width=10).grid(row=2, column=1, sticky=tk.W, padx=(10, 0), pady=5)
+        
+        ttk.Label(perf_frame, text="Dialogs Searched at Once:").grid(row=3, column=0, sticky=tk.W, pady=5)
+        ttk.Spinbox(perf_frame, from_=1, to=16, textvariable=self.dialog_parallelism, width=10).grid(row=3, column=1, sticky=tk.W, padx=(10, 0), pady=5)
+        
+        # Largest, a maximum width/height in pixels, the inline preview, or metadata only
+        ttk.Label(perf_frame, text="Image Quality:").grid(row=4, column=0, sticky=tk.W, pady=5)
+        ttk.Combobox(perf_frame, textvariable=self.image_quality, values=["largest", "1280", "800", "320", "stripped", "none"], width=10).grid(row=4, column=1, sticky=tk.W, padx=(10, 0), pady=5)
         
         # Paths Section
         paths_frame = ttk.LabelFrame(main_frame, text="Download Paths", padding=10)
@@ -112,7 +178,19 @@ class TelegramDownloaderGUI:
         search_frame.pack(fill=tk.X, pady=(0, 10))
         
         ttk.Label(search_frame, text="Search Query:").grid(row=0, column=0, sticky=tk.W, pady=5)
-        ttk.Entry(search_frame, textvariable=self.search_query, width=50).grid(row=0, column=1, sticky=tk.EW, padx=(10, 0), pady=5)
+        ttk.Entry(search_frame, textvariable=self.search_query, width=40).grid(row=0, column=1, sticky=tk.EW, padx=(10, 5), pady=5)
+        ttk.Button(search_frame, text="Search Offline", command=self.search_offline).grid(row=0, column=2, pady=5)
+        
+        # Optional batch of queries, one per line, run in the same job
+        ttk.Label(search_frame, text="Queries File:").grid(row=1, column=0, sticky=tk.W, pady=5)
+        ttk.Entry(search_frame, textvariable=self.queries_file, width=40).grid(row=1, column=1, sticky=tk.EW, padx=(10, 5), pady=5)
+        ttk.Button(search_frame, text="Browse", command=self.browse_queries_file).grid(row=1, column=2, pady=5)
+        
+        # Watch mode
+        ttk.Checkbutton(search_frame, text="Keep watching for new posts after the search", variable=self.watch).grid(row=2, column=1, columnspan=2, sticky=tk.W, padx=(10, 0), pady=5)
+        
+        # Local mirror of every photo, which answers the queries instead of Telegram's search
+        ttk.Checkbutton(search_frame, text="Scan every photo into the local mirror and search it there", variable=self.mirror_photos).grid(row=3, column=1, columnspan=2, sticky=tk.W, padx=(10, 0), pady=5)
         
         search_frame.columnconfigure(1, weight=1)
         
@@ -128,6 +206,9 @@ class TelegramDownloaderGUI:
         self.start_button = ttk.Button(control_frame, text="Start Download", command=self.start_download)
         self.start_button.pack(side=tk.LEFT, padx=(0, 5))
         
+        self.pause_button = ttk.Button(control_frame, text="Pause", command=self.pause_download, state=tk.DISABLED)
+        self.pause_button.pack(side=tk.LEFT, padx=(0, 5))
+        
         self.stop_button = ttk.Button(control_frame, text="Stop", command=self.stop_download, state=tk.DISABLED)
         self.stop_button.pack(side=tk.LEFT)
         
@@ -142,19 +223,96 @@ class TelegramDownloaderGUI:
         self.stats_var = tk.StringVar(value="Images: 0 | Archives: 0 | Failed: 0")
         ttk.Label(stats_frame, textvariable=self.stats_var).pack(side=tk.LEFT)
         
+        self.throughput_var = tk.StringVar(value="")
+        ttk.Label(stats_frame, textvariable=self.throughput_var).pack(side=tk.RIGHT)
+        
         self.progress_var = tk.StringVar(value="Ready")
         ttk.Label(progress_frame, textvariable=self.progress_var).pack(anchor=tk.W, pady=(0, 5))
         
         self.progress_bar = ttk.Progressbar(progress_frame, mode='indeterminate')
         self.progress_bar.pack(fill=tk.X, pady=(0, 10))
         
+        # Active transfers, refreshed from the engine's progress samples
+        columns = ("type", "progress", "size", "speed", "eta")
+        self.transfer_table = ttk.Treeview(progress_frame, columns=columns, height=TRANSFER_ROWS)
+        self.transfer_table.heading("#0", text="File")
+        self.transfer_table.column("#0", width=280, stretch=True)
+        for column, heading, width in (
+            ("type", "Type", 70), ("progress", "Progress", 80), ("size", "Size", 90),
+            ("speed", "Speed", 90), ("eta", "ETA", 70)
+        ):
+            self.transfer_table.heading(column, text=heading)
+            self.transfer_table.column(column, width=width, stretch=False, anchor=tk.E)
+        self.transfer_table.pack(fill=tk.X, pady=(0, 10))
+        
         # Log Text Area
         self.log_text = scrolledtext.ScrolledText(progress_frame, height=15, width=80)
         self.log_text.pack(fill=tk.BOTH, expand=True)
         
+    def _sync_chunk_size(self):
+        """Keep the byte chunk size in step with the MB spinbox"""
+        try:
+            self.chunk_size.set(self.chunk_mb.get() * 1024 * 1024)
+        except tk.TclError:
+            # Spinbox is mid-edit and does not hold a number yet
+            pass
+        
+    def _on_engine_stats(self, images, archives, failed):
+        """Receive download counters from the engine"""
+        self.downloaded_images = images
+        self.downloaded_archives = archives
+        self.failed_downloads = failed
+        self.update_stats()
+        
     def update_stats(self):
         """Update statistics display"""
-        self.stats_var.set(f"Images: {self.downloaded_images} | Archives: {self.downloaded_archives} | Failed: {self.failed_downloads}")
+        self.ui_events.put(("stats", f"Images: {self.downloaded_images} | Archives: {self.downloaded_archives} | Failed: {self.failed_downloads}"))
+    
+    def set_status(self, status):
+        """Update the one-line progress status"""
+        self.ui_events.put(("status", status))
+    
+    def _on_engine_progress(self, sample):
+        """Receive a progress sample from the engine; only the newest one is shown"""
+        self.ui_events.put(("progress", sample))
+    
+    def _apply_progress(self, sample):
+        """Show a progress sample in the transfers table, the throughput label and the bar"""
+        rows = {transfer["name"]: transfer for transfer in sample["transfers"]}
+        for item in self.transfer_table.get_children():
+            if item not in rows:
+                self.transfer_table.delete(item)
+        for name, transfer in rows.items():
+            percent = f"{transfer['done'] * 100 // transfer['total']}%" if transfer["total"] else format_bytes(transfer["done"])
+            values = (
+                transfer["kind"],
+                percent,
+                format_bytes(transfer["total"]) if transfer["total"] else "?",
+                f"{format_bytes(transfer['bytes_per_second'])}/s",
+                format_eta(transfer["eta_seconds"])
+            )
+            if self.transfer_table.exists(name):
+                self.transfer_table.item(name, values=values)
+            else:
+                self.transfer_table.insert("", tk.END, iid=name, text=name, values=values)
+        
+        speed = f"{sample['bytes_per_second'] / (1024 * 1024):.2f} MB/s"
+        if sample["jobs_total"] is None:
+            self.throughput_var.set(f"{speed} | {sample['jobs_done']} jobs done")
+            return
+        
+        # The job list is complete, so the bar can show real progress
+        if str(self.progress_bar.cget("mode")) != "determinate":
+            self.progress_bar.stop()
+            self.progress_bar.config(mode='determinate')
+        self.progress_bar.config(maximum=max(1, sample["jobs_total"]), value=sample["jobs_done"])
+        self.throughput_var.set(
+            f"{speed} | {sample['jobs_done']}/{sample['jobs_total']} jobs | ETA {format_eta(sample['eta_seconds'])}"
+        )
+    
+    def call_in_ui(self, func, *args, **kwargs):
+        """Run a widget or dialog call on the Tk thread"""
+        self.ui_events.put(("call", (func, args, kwargs)))
         
     def browse_session_file(self):
         filename = filedialog.asksaveasfilename(
@@ -173,23 +331,41 @@ class TelegramDownloaderGUI:
         if folder:
             self.images_path.set(folder)
     
+    def browse_queries_file(self):
+        filename = filedialog.askopenfilename(
+            title="Select Queries File",
+            filetypes=[("Text files", "*.txt"), ("All files", "*.*")]
+        )
+        if filename:
+            self.queries_file.set(filename)
+    
     def browse_archives_folder(self):
         folder = filedialog.askdirectory(title="Select Archives Download Folder")
         if folder:
             self.archives_path.set(folder)
     
-    def save_config(self):
-        config = {
+    def get_config(self):
+        """Collect the current form values with the same keys as config.json"""
+        return dict(self.extra_config, **{
             "api_id": self.api_id.get(),
             "api_hash": self.api_hash.get(),
             "phone_number": self.phone_number.get(),
             "session_path": self.session_path.get(),
             "search_query": self.search_query.get(),
+            "queries_file": self.queries_file.get(),
+            "watch": self.watch.get(),
+            "mirror_photos": self.mirror_photos.get(),
             "images_path": self.images_path.get(),
             "archives_path": self.archives_path.get(),
             "max_concurrent_downloads": self.max_concurrent_downloads.get(),
-            "chunk_size": self.chunk_size.get()
-        }
+            "chunk_size": self.chunk_size.get(),
+            "max_parallel_parts": self.max_parallel_parts.get(),
+            "dialog_parallelism": self.dialog_parallelism.get(),
+            "image_quality": self.image_quality.get()
+        })
+    
+    def save_config(self):
+        config = self.get_config()
         
         try:
             with open(self.config_file, 'w') as f:
@@ -208,15 +384,23 @@ class TelegramDownloaderGUI:
             with open(self.config_file, 'r') as f:
                 config = json.load(f)
             
+            self.extra_config = config
             self.api_id.set(config.get("api_id", ""))
             self.api_hash.set(config.get("api_hash", ""))
             self.phone_number.set(config.get("phone_number", ""))
             self.session_path.set(config.get("session_path", ""))
             self.search_query.set(config.get("search_query", ""))
+            self.queries_file.set(config.get("queries_file", ""))
+            self.watch.set(bool(config.get("watch", False)))
+            self.mirror_photos.set(bool(config.get("mirror_photos", False)))
             self.images_path.set(config.get("images_path", ""))
             self.archives_path.set(config.get("archives_path", ""))
             self.max_concurrent_downloads.set(config.get("max_concurrent_downloads", 3))
             self.chunk_size.set(config.get("chunk_size", 1024*1024))
+            self.chunk_mb.set(max(1, self.chunk_size.get() // (1024*1024)))
+            self.max_parallel_parts.set(config.get("max_parallel_parts", 8))
+            self.dialog_parallelism.set(config.get("dialog_parallelism", 3))
+            self.image_quality.set(str(config.get("image_quality", "largest")))
             
             self.log("✅ Configuration loaded successfully")
         except Exception as e:
@@ -224,11 +408,71 @@ class TelegramDownloaderGUI:
             messagebox.showerror("Error", f"Failed to load configuration: {e}")
     
     def log(self, message):
-        """Add message to log text area"""
+        """Add message to log text area; safe to call from any thread"""
         timestamp = time.strftime("%H:%M:%S")
-        self.log_text.insert(tk.END, f"[{timestamp}] {message}\n")
-        self.log_text.see(tk.END)
-        self.root.update_idletasks()
+        self.ui_events.put(("log", f"[{timestamp}] {message}\n"))
+        self.file_logger.info(message)
+    
+    def _create_file_logger(self):
+        """Create the logger that keeps the full log in a rotating file"""
+        file_logger = logging.getLogger("telegram_downloader.ui")
+        file_logger.propagate = False
+        if not file_logger.handlers:
+            handler = logging.handlers.RotatingFileHandler(
+                LOG_FILE,
+                maxBytes=LOG_FILE_MAX_BYTES,
+                backupCount=LOG_FILE_BACKUPS,
+                encoding="utf-8"
+            )
+            handler.setFormatter(logging.Formatter('%(asctime)s - %(message)s'))
+            file_logger.addHandler(handler)
+        return file_logger
+    
+    def _drain_ui_events(self):
+        """Apply everything queued since the last frame with one insert and one stats update"""
+        lines = []
+        stats = None
+        status = None
+        progress = None
+        calls = []
+        
+        while True:
+            try:
+                kind, payload = self.ui_events.get_nowait()
+            except queue.Empty:
+                break
+            if kind == "log":
+                lines.append(payload)
+            elif kind == "stats":
+                stats = payload
+            elif kind == "status":
+                status = payload
+            elif kind == "progress":
+                progress = payload
+            elif kind == "call":
+                calls.append(payload)
+        
+        if lines:
+            # Older lines would be trimmed right away, so only insert the tail
+            self.log_text.insert(tk.END, "".join(lines[-LOG_MAX_LINES:]))
+            line_count = int(self.log_text.index('end-1c').split('.')[0])
+            if line_count > LOG_MAX_LINES:
+                self.log_text.delete('1.0', f'{line_count - LOG_MAX_LINES}.0')
+            self.log_text.see(tk.END)
+        if stats is not None:
+            self.stats_var.set(stats)
+        if status is not None:
+            self.progress_var.set(status)
+        if progress is not None:
+            self._apply_progress(progress)
+        
+        for func, args, kwargs in calls:
+            try:
+                func(*args, **kwargs)
+            except Exception as e:
+                logging.error(f"UI call failed: {e}")
+        
+        self.root.after(UI_REFRESH_MS, self._drain_ui_events)
     
     def validate_config(self):
         """Validate configuration before starting"""
@@ -244,14 +488,20 @@ class TelegramDownloaderGUI:
             messagebox.showerror("Error", "Session file path is required")
             return False
         
-        if not self.search_query.get():
-            messagebox.showerror("Error", "Search query is required")
+        if not self.search_query.get() and not self.queries_file.get() and not self.extra_config.get("search_queries"):
+            messagebox.showerror("Error", "A search query or a queries file is required")
             return False
         
         if not self.images_path.get() or not self.archives_path.get():
             messagebox.showerror("Error", "Both images and archives paths are required")
             return False
         
+        try:
+            parse_image_quality(self.image_quality.get())
+        except ValueError as e:
+            messagebox.showerror("Error", str(e))
+            return False
+        
         # Create directories if they don't exist
         try:
             os.makedirs(self.images_path.get(), exist_ok=True)
@@ -272,6 +522,16 @@ class TelegramDownloaderGUI:
             messagebox.showerror("Error", "Please select a session file path first")
             return
         
+        if self.is_running:
+            messagebox.showwarning("Warning", "Stop the running download before setting up a new session")
+            return
+        
+        # The shared client must let go of the session file before it is replaced
+        try:
+            self.runner.submit(self.runner.drop_client()).result(10)
+        except Exception as e:
+            self.log(f"⚠️ Could not disconnect the current client: {e}")
+        
         # Check if session already exists
         session_file = self.session_path.get() + ".session"
         if os.path.exists(session_file):
@@ -290,43 +550,49 @@ class TelegramDownloaderGUI:
                 except Exception as e:
                     self.log(f"⚠️ Could not remove existing session: {e}")
         
-        def setup_async():
-            loop = asyncio.new_event_loop()
-            asyncio.set_event_loop(loop)
-            try:
-                client = TelegramClient(
-                    self.session_path.get(),
-                    int(self.api_id.get()),
-                    self.api_hash.get()
-                )
-                loop.run_until_complete(self._setup_session_async(client))
-            except Exception as e:
+        def setup_done(future):
+            e = future.exception()
+            if e is not None:
                 self.log(f"❌ Session setup failed: {e}")
-                messagebox.showerror("Setup Error", f"Failed to setup session: {e}")
-            finally:
-                loop.close()
+                self.call_in_ui(messagebox.showerror, "Setup Error", f"Failed to setup session: {e}")
         
         self.log("🔧 Starting session setup...")
-        threading.Thread(target=setup_async, daemon=True).start()
+        # Runs on the shared client loop, so the new session is the client the next test or download reuses
+        self.runner.submit(self._setup_session_async(self.get_config(), self.phone_number.get())).add_done_callback(setup_done)
+    
+    async def _ask_in_ui(self, ask):
+        """Show a dialog on the Tk thread and wait for its answer without blocking the client loop"""
+        answer = concurrent.futures.Future()
+        
+        def run():
+            try:
+                answer.set_result(ask())
+            except Exception as e:
+                answer.set_exception(e)
+        
+        self.call_in_ui(run)
+        return await asyncio.wrap_future(answer)
     
-    async def _setup_session_async(self, client):
+    async def _setup_session_async(self, config, phone):
+        logged_in = False
         try:
             self.log("📱 Connecting to Telegram...")
+            client = await self.runner.get_client(config)
             await client.start(
-                phone=lambda: self.phone_number.get(),
-                code_callback=self._get_code,
-                password=self._get_password
+                phone=phone,
+                code_callback=lambda: self._ask_in_ui(self._get_code),
+                password=lambda: self._ask_in_ui(self._get_password)
             )
             
             # Get user info to confirm login
             me = await client.get_me()
+            logged_in = True
             self.log(f"✅ Successfully logged in as: {me.first_name} {me.last_name or ''}")
             self.log(f"📞 Phone: {me.phone}")
             self.log(f"🆔 User ID: {me.id}")
             
-            await client.disconnect()
-            
-            messagebox.showinfo(
+            self.call_in_ui(
+                messagebox.showinfo,
                 "Success", 
                 f"Session created successfully!\n\nLogged in as: {me.first_name} {me.last_name or ''}\nPhone: {me.phone}"
             )
@@ -342,6 +608,10 @@ class TelegramDownloaderGUI:
             raise Exception(f"Too many attempts. Please wait {e.seconds} seconds and try again.")
         except Exception as e:
             raise e
+        finally:
+            if not logged_in:
+                # A half logged-in client must not be reused by the next test or download
+                await self.runner.drop_client()
     
     def test_connection(self):
         """Test Telegram connection with proper authentication"""
@@ -363,36 +633,55 @@ class TelegramDownloaderGUI:
             messagebox.showerror("Error", f"Session file not found at {session_file}. Please setup session first.")
             return
         
-        def test_async():
-            loop = asyncio.new_event_loop()
-            asyncio.set_event_loop(loop)
-            try:
-                client = TelegramClient(
-                    self.session_path.get(),
-                    int(self.api_id.get()),
-                    self.api_hash.get()
-                )
-                loop.run_until_complete(self._test_connection_async(client))
-            except Exception as e:
+        def test_done(future):
+            e = future.exception()
+            if e is not None:
                 self.log(f"❌ Connection test failed: {e}")
-                messagebox.showerror("Connection Error", f"Failed to connect: {e}")
-            finally:
-                loop.close()
+                self.call_in_ui(messagebox.showerror, "Connection Error", f"Failed to connect: {e}")
         
-        threading.Thread(target=test_async, daemon=True).start()
+        self.runner.submit(self._test_connection_async(self.get_config())).add_done_callback(test_done)
     
-    async def _test_connection_async(self, client):
+    async def _test_connection_async(self, config):
+        # The connection stays open afterwards and is reused by the next download
+        client = await self.runner.get_client(config)
+        if not await client.is_user_authorized():
+            raise Exception("Session is not authorized. Please setup session again.")
+        
+        me = await client.get_me()
+        self.log(f"✅ Connection test successful! Logged in as: {me.first_name}")
+        self.call_in_ui(messagebox.showinfo, "Success", f"Connection successful!\nLogged in as: {me.first_name} {me.last_name or ''}")
+    
+    def search_offline(self):
+        """List the messages of the local mirror that contain the search query, without connecting"""
+        text = self.search_query.get().strip()
+        if not text:
+            messagebox.showerror("Error", "Enter the text to look for in Search Query")
+            return
+        
+        state_path = state_path_for(self.session_path.get())
+        if not self.session_path.get() or not os.path.exists(state_path):
+            messagebox.showinfo("Search Offline", "There is no local mirror yet. It is filled by the first download.")
+            return
+        
         try:
-            await client.connect()
-            if not await client.is_user_authorized():
-                raise Exception("Session is not authorized. Please setup session again.")
-            
-            me = await client.get_me()
-            self.log(f"✅ Connection test successful! Logged in as: {me.first_name}")
-            messagebox.showinfo("Success", f"Connection successful!\nLogged in as: {me.first_name} {me.last_name or ''}")
-            await client.disconnect()
-        except Exception as e:
-            raise e
+            mirror = MessageMirror(state_path)
+            crawl_state = CrawlState(state_path)
+            try:
+                rows = mirror.search(text, limit=50)
+                statuses = crawl_state.code_statuses({row["code"] for row in rows if row["code"]})
+            finally:
+                crawl_state.close()
+                mirror.close()
+        except sqlite3.Error as e:
+            self.log(f"❌ Offline search failed: {e}")
+            return
+        
+        self.log(f"🗂️ {len(rows)} mirrored messages contain '{text}'")
+        for row in rows:
+            # New codes are the ones the next run of a matching query would download
+            status = statuses.get(row["code"], "new") if row["code"] else "-"
+            self.log(f"   {row['kind']} {row['dialog_id']}/{row['message_id']} | {row['code'] or '-'} | {status} | "
+                     f"{row['file_name'] or row['caption'][:60]}")
     
     def start_download(self):
         """Start the download process"""
@@ -417,230 +706,68 @@ class TelegramDownloaderGUI:
         
         self.is_running = True
         self.start_button.config(state=tk.DISABLED)
+        self.pause_button.config(state=tk.NORMAL)
         self.stop_button.config(state=tk.NORMAL)
         self.progress_bar.start()
         self.progress_var.set("Starting download...")
         
-        def download_async():
-            loop = asyncio.new_event_loop()
-            asyncio.set_event_loop(loop)
-            try:
-                self.client = TelegramClient(
-                    self.session_path.get(),
-                    int(self.api_id.get()),
-                    self.api_hash.get(),
-                    connection_retries=5,
-                    retry_delay=1
-                )
-                loop.run_until_complete(self._download_process())
-            except Exception as e:
+        config = self.get_config()
+        self.engine = ScraperEngine(
+            config,
+            log_callback=self.log,
+            stats_callback=self._on_engine_stats,
+            status_callback=self.set_status,
+            progress_callback=self._on_engine_progress
+        )
+        
+        def download_done(future):
+            e = future.exception()
+            if e is not None:
                 self.log(f"❌ Download failed: {e}")
-                messagebox.showerror("Download Error", f"Download failed: {e}")
-            finally:
-                self._reset_ui()
-                loop.close()
+                self.call_in_ui(messagebox.showerror, "Download Error", f"Download failed: {e}")
+            self.call_in_ui(self._reset_ui)
         
-        threading.Thread(target=download_async, daemon=True).start()
+        self.runner.submit(self._download_async(self.engine, config)).add_done_callback(download_done)
+    
+    async def _download_async(self, engine, config):
+        # Reuse the connected client instead of reconnecting for every run
+        engine.client = await self.runner.get_client(config)
+        await engine.run()
     
     def stop_download(self):
-        """Stop the download process"""
+        """Stop the download process; running transfers are cancelled right away"""
         self.is_running = False
+        if self.engine:
+            self.engine.stop()
         self.progress_var.set("Stopping...")
         self.log("🛑 Stop requested...")
     
+    def pause_download(self):
+        """Stop the download process so that Resume continues where it stopped"""
+        self.is_running = False
+        if self.engine:
+            self.engine.pause()
+        self.progress_var.set("Pausing...")
+        self.log("⏸️ Pause requested...")
+    
+    def on_close(self):
+        """Stop any running download and disconnect before the window closes"""
+        if self.engine:
+            self.engine.stop()
+        self.runner.stop()
+        self.root.destroy()
+    
     def _reset_ui(self):
         """Reset UI after download completion or stop"""
         self.is_running = False
-        self.start_button.config(state=tk.NORMAL)
+        paused = self.engine is not None and self.engine.paused
+        self.start_button.config(state=tk.NORMAL, text="Resume" if paused else "Start Download")
+        self.pause_button.config(state=tk.DISABLED)
         self.stop_button.config(state=tk.DISABLED)
         self.progress_bar.stop()
-        self.progress_var.set("Ready")
-    
-    async def _download_process(self):
-        """Main download process"""
-        try:
-            await self.client.connect()
-            if not await self.client.is_user_authorized():
-                raise Exception("Session is not authorized. Please setup session again.")
-            
-            self.log("✅ Connected to Telegram")
-            
-            # Create a semaphore to limit concurrent downloads
-            semaphore = asyncio.Semaphore(self.max_concurrent_downloads.get())
-            
-            self.progress_var.set("Searching and downloading...")
-            await self.search_and_download_pairs(semaphore)
-            
-            self.log("✅ Download process completed!")
-            self.progress_var.set("Completed")
-            
-        except Exception as e:
-            self.log(f"❌ Error in download process: {e}")
-            raise e
-        finally:
-            if self.client:
-                await self.client.disconnect()
-    
-    async def download_with_progress(self, message, file_path, semaphore, file_type="file"):
-        """Download a single file with progress tracking and error handling"""
-        async with semaphore:
-            try:
-                # Skip if file already exists
-                if os.path.exists(file_path):
-                    self.log(f"⏭️ Skipping existing {file_type}: {os.path.basename(file_path)}")
-                    return True
-                
-                # Download the file
-                await self.client.download_media(
-                    message.media, 
-                    file=file_path
-                )
-                
-                if file_type == "image":
-                    self.downloaded_images += 1
-                else:
-                    self.downloaded_archives += 1
-                    
-                self.update_stats()
-                self.log(f"📥 Downloaded {file_type}: {os.path.basename(file_path)}")
-                return True
-                
-            except Exception as e:
-                self.failed_downloads += 1
-                self.update_stats()
-                self.log(f"❌ Failed to download {file_type} {os.path.basename(file_path)}: {e}")
-                return False
-    
-    async def search_and_download_pairs(self, semaphore):
-        """Search for images and immediately download corresponding archives"""
-        search_name = self.search_query.get()
-        processed_codes = set()
-        
-        async for dialog in self.client.iter_dialogs():
-            if not self.is_running:
-                break
-                
-            try:
-                # Search for images in this dialog
-                async for message in self.client.iter_messages(dialog.entity, search=search_name):
-                    if not self.is_running:
-                        break
-                        
-                    # Skip non-photo messages
-                    if not message.media or not message.photo:
-                        continue
-                    
-                    # Get filename and extract code
-                    if hasattr(message, 'file') and message.file and hasattr(message.file, 'name') and message.file.name:
-                        file_name = message.file.name
-                    else:
-                        if message.text:
-                            file_name = message.text.strip().replace("\n", " ")
-                        else:
-                            file_name = f"{message.id}.jpg"
-                    
-                    code, clean_name = self.extract_code_and_description(file_name)
-                    if not code or len(code) < 3 or "*" in code or code in processed_codes:
-                        continue
-                    
-                    processed_codes.add(code)
-                    
-                    # Prepare image download
-                    file_ext = ".jpg"
-                    if hasattr(message, 'file') and message.file and hasattr(message.file, 'ext'):
-                        file_ext = message.file.ext or ".jpg"
-                    
-                    image_path = os.path.join(self.images_path.get(), clean_name + file_ext)
-                    
-                    self.log(f"🔍 Found image with code: {code}")
-                    
-                    # Download image immediately
-                    image_success = await self.download_with_progress(message, image_path, semaphore, "image")
-                    
-                    if image_success and self.is_running:
-                        # Now search for corresponding archive
-                        archive_found = await self.search_and_download_archive_for_code(code, clean_name, semaphore)
-                        if not archive_found:
-                            self.log(f"⚠️ No archive found for code: {code}")
-                    
-                    # Add small delay to prevent overwhelming the server
-                    await asyncio.sleep(0.1)
-                        
-            except errors.FloodWaitError as e:
-                self.log(f"⏳ Rate limited, waiting {e.seconds} seconds...")
-                await asyncio.sleep(e.seconds)
-            except errors.RPCError as e:
-                self.log(f"⚠️ RPC Error in {dialog.name}: {e}")
-            except Exception as e:
-                self.log(f"🚨 Unexpected error in {dialog.name}: {e}")
-    
-    async def search_and_download_archive_for_code(self, code, file_name, semaphore):
-        """Search and download archive for a specific code"""
-        async for dialog in self.client.iter_dialogs():
-            if not self.is_running:
-                return False
-                
-            try:
-                async for message in self.client.iter_messages(dialog.entity, search=code):
-                    if not self.is_running:
-                        return False
-                        
-                    if not message.media or not message.document:
-                        continue
-                    
-                    complete_file_name = ""
-                    if hasattr(message, 'file') and message.file and hasattr(message.file, 'name'):
-                        complete_file_name = message.file.name or ''
-                    
-                    if not self.is_archive(complete_file_name):
-                        continue
-                    
-                    # Found matching archive
-                    ext = os.path.splitext(complete_file_name)[1] or ".rar"
-                    archive_path = os.path.join(self.archives_path.get(), file_name + ext)
-                    
-                    success = await self.download_with_progress(message, archive_path, semaphore, "archive")
-                    if success:
-                        return True
-                        
-            except errors.FloodWaitError as e:
-                self.log(f"⏳ Rate limited, waiting {e.seconds} seconds...")
-                await asyncio.sleep(e.seconds)
-            except errors.RPCError as e:
-                self.log(f"⚠️ RPC Error searching for {code}: {e}")
-            except Exception as e:
-                self.log(f"🚨 Unexpected error searching for {code}: {e}")
-        
-        return False
-    
-    def extract_code_and_description(self, file_name: str):
-        """Extract code and description from filename"""
-        file_name = file_name.strip()
-        
-        match = re.match(r'^([^\s]+)\s+([\s\S]+)$', file_name)
-        if not match:
-            return None, self.sanitize_filename(file_name)
-        
-        code = match.group(1)
-        description_part = match.group(2).strip()
-        
-        description_clean = re.sub(r'#.*', '', description_part, flags=re.DOTALL).strip()
-        description_clean = re.sub(r'\s+', ' ', description_clean)
-        description_clean = self.sanitize_filename(description_clean)
-        
-        return code, description_clean
-    
-    def sanitize_filename(self, name: str):
-        """Sanitize filename for filesystem compatibility"""
-        name = re.sub(r'[.-]', ' ', name)
-        name = re.sub(r'[<>:"/\\|?*\n\r]', '', name)
-        return name.strip()
-    
-    def is_archive(self, file_name):
-        """Check if file is an archive"""
-        if not file_name:
-            return False
-        return file_name.lower().endswith(('.rar', '.zip', '.7z', '.tar', '.gz', '.bz2'))
+        self.progress_bar.config(mode='indeterminate', value=0)
+        self.transfer_table.delete(*self.transfer_table.get_children())
+        self.progress_var.set("Paused" if paused else "Ready")
     
     def _get_code(self):
         """Get verification code from user with improved dialog"""